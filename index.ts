@@ -22,6 +22,7 @@ const py = spawn(".venv/bin/python3", ["polyfish/main.py"]);
 type Task = { data: string, resolve: (value: Prediction) => void };
 const queue: Task[] = [];
 let current: Task | null = null;
+let pyReady = false;
 let currentGame = new Game();
 
 (BigInt.prototype as any).toJSON = function() {
@@ -33,11 +34,17 @@ let currentGame = new Game();
 };
 
 py.stderr.on("data", (data: any) => {
-    console.log(data.toString());
+    const text = data.toString();
+    // main.py reports readiness on stderr once the model is loaded and warmed up
+    if(!pyReady && text.includes('"status": "ready"')) {
+        pyReady = true;
+        next();
+    }
+    console.log(text);
 })
 
 const next = () => {
-    if(current) {
+    if(current || !pyReady) {
         return;
     }
     
@@ -47,28 +54,40 @@ const next = () => {
         return;
     }
     
-    py.stdout.once("data", (data: any) => {
+    py.stdin.write(current!.data + '\n');
+}
+
+// Replies are newline terminated, a large one (e.g. predict_batch) may span several chunks
+let pyBuffer = '';
+py.stdout.on("data", (data: any) => {
+    pyBuffer += data.toString();
+    let newline: number;
+    while((newline = pyBuffer.indexOf('\n')) >= 0) {
+        const line = pyBuffer.slice(0, newline);
+        pyBuffer = pyBuffer.slice(newline + 1);
+        if(!current) {
+            continue;
+        }
         try {
-            current!.resolve(JSON.parse(data.toString()));
+            current!.resolve(JSON.parse(line));
         } catch (error) {
             console.log(error);
             console.log('CONTENT');
-            console.log(data.toString());
+            console.log(line);
             current!.resolve({ } as any);
         } finally {
             current = null;
             next();
         }
-    });
-    
-    py.stdin.write(current!.data + '\n');
-}
+    }
+});
 
 async function predict(state: GameState): Promise<Prediction> {
     return new Promise((resolve) => {
         queue.push({ data: JSON.stringify({
             ...AIState.extract(state),
-            cmd: 'predict'
+            cmd: 'predict',
+            priority: 'high'
         }), resolve });
         next();
     });
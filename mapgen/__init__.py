@@ -1 +1 @@
-import main, utils
\ No newline at end of file
+import main, utils, cache
\ No newline at end of file
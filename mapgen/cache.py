@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Eviction trims the directory to this fraction of max_bytes, so it does not rescan on every write
+EVICT_TO = 0.9
+
+def cache_key(version, map_size, initial_land, smoothing, relief, tribes, seed):
+    params = [version, map_size, initial_land, smoothing, relief, list(tribes), seed]
+    return hashlib.sha256(json.dumps(params, separators=(',', ':')).encode()).hexdigest()
+
+class MapCache:
+    """
+    On-disk cache of encoded maps, one file per key.
+    File mtimes double as LRU timestamps, hits touch the file and writes evict the
+    least recently used entries once the directory grows past max_bytes.
+    The directory size is tracked in memory between scans, writes from other processes
+    are picked up at the next eviction.
+    Safe to share between processes, a lost race only costs a regeneration.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                encoded = json.load(f)
+            os.utime(path)
+            return encoded
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, key, encoded):
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(encoded, f, separators=(',', ':'))
+            size = f.tell()
+        try:
+            size -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+        self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICT_TO
+        entries.sort()
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
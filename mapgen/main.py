@@ -1,7 +1,23 @@
 import random
 import utils
+import cache
 import argparse
 import json
+import sys
+from multiprocessing import Pool
+
+MAX_SEED = 2 ** 31 - 1
+
+# Bump whenever a change alters the map produced for a given seed
+GENERATOR_VERSION = 1
+
+# Int codes used by the compact (batch) output, index == code
+TERRAIN_CODES = ['ocean', 'water', 'ground', 'forest', 'mountain']
+ABOVE_CODES = [None, 'capital', 'village', 'ruin', 'fruit', 'crop', 'spore', 'game', 'fish', 'starfish', 'metal']
+TRIBE_CODES = [
+    'XinXi', 'Imperius', 'Bardur', 'Oumaji', 'Kickoo', 'Hoodrick', 'Luxidoor', 'Vengir',
+    'Zebasi', 'AiMo', 'Quetzali', 'Yadakk', 'Aquarion', 'Elyrion', 'Cymanti', 'Polaris'
+]
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Generate a map with specified parameters.")
@@ -11,11 +27,86 @@ def parse_args():
     parser.add_argument('--relief', type=int, default=4, help='Relief level (default: 4)')
     parser.add_argument('--tribes', nargs='+', default=['Vengir', 'Bardur', 'Oumaji'], help='List of tribes (space-separated)')
     parser.add_argument('--seed', type=int, default=None, help='The seed to use (default: None)')
+    parser.add_argument('--count', type=int, default=None, help='Batch mode, number of maps to generate (default: None)')
+    parser.add_argument('--workers', type=int, default=1, help='Batch mode, number of worker processes (default: 1)')
+    parser.add_argument('--out', type=str, default='-', help='Batch mode, NDJSON output file, - for stdout (default: -)')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Batch mode, directory to cache generated maps in (default: None)')
+    parser.add_argument('--cache-size', type=int, default=256, help='Batch mode, max cache directory size in MB (default: 256)')
     return parser.parse_args()
 
-def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
-    if seed is not None:
-        random.seed(seed)
+def derive_seed(base_seed, index):
+    # Stable across runs and platforms, str seeds are hashed with sha512
+    return random.Random(f"{base_seed}:{index}").randrange(MAX_SEED)
+
+def encode(world_map):
+    return {
+        'type': [TERRAIN_CODES.index(x['type']) for x in world_map],
+        'above': [ABOVE_CODES.index(x['above']) for x in world_map],
+        'tribe': [TRIBE_CODES.index(x['tribe']) for x in world_map],
+    }
+
+def decode(encoded):
+    return [{
+        'type': TERRAIN_CODES[t],
+        'above': ABOVE_CODES[a],
+        'road': False,
+        'tribe': TRIBE_CODES[r],
+    } for t, a, r in zip(encoded['type'], encoded['above'], encoded['tribe'])]
+
+def generate_encoded(map_size, initial_land, smoothing, relief, tribes, seed, map_cache=None):
+    """Like generate but returns the encoded map, served from `map_cache` when given and seeded."""
+    key = None
+    if map_cache is not None and seed is not None:
+        key = cache.cache_key(GENERATOR_VERSION, map_size, initial_land, smoothing, relief, tribes, seed)
+        encoded = map_cache.get(key)
+        if encoded is not None:
+            return encoded
+    encoded = {
+        'seed': seed,
+        'size': map_size,
+        **encode(generate(map_size, initial_land, smoothing, relief, tribes, seed))
+    }
+    if key is not None:
+        map_cache.put(key, encoded)
+    return encoded
+
+# One MapCache per process, opened by _init_worker
+_worker_cache = None
+
+def _init_worker(cache_dir, cache_bytes):
+    global _worker_cache
+    _worker_cache = cache.MapCache(cache_dir, cache_bytes) if cache_dir else None
+
+def _generate_encoded(job):
+    return generate_encoded(*job, map_cache=_worker_cache)
+
+def generate_batch(count, map_size, initial_land, smoothing, relief, tribes, base_seed=None, workers=1,
+                   cache_dir=None, cache_bytes=cache.DEFAULT_MAX_BYTES):
+    """Yields `count` encoded maps in order, map i is generated from derive_seed(base_seed, i)."""
+    if base_seed is None:
+        base_seed = random.randrange(MAX_SEED)
+    jobs = [
+        (map_size, initial_land, smoothing, relief, tribes, derive_seed(base_seed, i))
+        for i in range(count)
+    ]
+    if workers <= 1:
+        _init_worker(cache_dir, cache_bytes)
+        yield from map(_generate_encoded, jobs)
+        return
+    with Pool(workers, initializer=_init_worker, initargs=(cache_dir, cache_bytes)) as pool:
+        yield from pool.imap(_generate_encoded, jobs, chunksize=max(1, count // (workers * 4)))
+
+def generate(map_size, initial_land, smoothing, relief, tribes, seed=None, rng=None):
+    """
+    Generates a map as a flat list of map_size ** 2 tile dicts.
+
+    All randomness is drawn from `rng`, never from the global `random` state, so
+    calls are safe to run concurrently. When `rng` is None a fresh
+    `random.Random(seed)` is used: the same parameters and seed always yield
+    the same map for a given GENERATOR_VERSION (seed None draws from OS entropy).
+    """
+    if rng is None:
+        rng = random.Random(seed)
 
     terrain = ['forest', 'fruit', 'game', 'ground', 'mountain']
 
@@ -112,7 +203,7 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
 
     j = 0
     while j < map_size ** 2 * initial_land:
-        cell = random.randrange(0, map_size ** 2)
+        cell = rng.randrange(0, map_size ** 2)
         if world_map[cell]['type'] == 'ocean':
             j += 1
             world_map[cell]['type'] = 'ground'
@@ -169,7 +260,7 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
 
         # choose one of the cells whose score equals max_dist
         choices = [c for c, d in capital_map.items() if d == max_dist]
-        chosen = random.choice(choices)
+        chosen = rng.choice(choices)
         capital_cells.append(chosen)
         world_map[chosen]['above'] = 'capital'
         world_map[chosen]['tribe'] = tribe
@@ -185,7 +276,7 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
     while len(done_tiles) != map_size ** 2:
         for i in range(len(tribes)):
             if len(active_tiles[i]) and tribes[i] != 'Polaris':
-                rand_number = random.randrange(0, len(active_tiles[i]))
+                rand_number = rng.randrange(0, len(active_tiles[i]))
                 rand_cell = active_tiles[i][rand_number]
                 neighbours = utils.circle(rand_cell, 1, map_size)
                 valid_neighbours = list(filter(lambda tile: tile not in done_tiles and
@@ -193,7 +284,7 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
                 if not len(valid_neighbours):
                     valid_neighbours = list(filter(lambda tile: tile not in done_tiles, neighbours))
                 if len(valid_neighbours):
-                    new_rand_number = random.randrange(0, len(valid_neighbours))
+                    new_rand_number = rng.randrange(0, len(valid_neighbours))
                     new_rand_cell = valid_neighbours[new_rand_number]
                     world_map[new_rand_cell]['tribe'] = tribes[i]
                     active_tiles[i].append(new_rand_cell)
@@ -204,12 +295,12 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
     for cell in range(map_size**2):
         if world_map[cell]['type'] == 'ground' and world_map[cell]['above'] is None:
             tribe_key = world_map[cell].get('otribe', world_map[cell]['tribe'])
-            rand = random.random()
+            rand = rng.random()
             if rand < general_probs['forest'] * terrain_probs['forest'][tribe_key]:
                 world_map[cell]['type'] = 'forest'
             elif rand > 1 - general_probs['mountain'] * terrain_probs['mountain'][tribe_key]:
                 world_map[cell]['type'] = 'mountain'
-            rand = random.random()
+            rand = rng.random()
             if rand < terrain_probs['water'][tribe_key]:
                 world_map[cell]['type'] = 'ocean'
 
@@ -241,7 +332,7 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
             village_map[cell] = max(village_map[cell], 1)
 
     while 0 in village_map:
-        new_village = random.choice(list(filter(lambda tile: True if village_map[tile] == 0 else False,
+        new_village = rng.choice(list(filter(lambda tile: True if village_map[tile] == 0 else False,
                                                 list(range(len(village_map))))))
         village_map[new_village] = 3
         for cell in utils.circle(new_village, 1, map_size):
@@ -251,8 +342,8 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
         village_count += 1
 
     def proc(cell_, probability):
-        return (village_map[cell_] == 2 and random.random() < probability) or\
-            (village_map[cell_] == 1 and random.random() < probability * BORDER_EXPANSION)
+        return (village_map[cell_] == 2 and rng.random() < probability) or\
+            (village_map[cell_] == 1 and rng.random() < probability * BORDER_EXPANSION)
     
     for cell in range(map_size**2):
         tribe_key = world_map[cell].get('otribe', world_map[cell]['tribe'])
@@ -294,7 +385,7 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
     water_ruins_count = 0
 
     while ruins_count < ruins_number:
-        ruin = random.choice(list(filter(lambda tile: True if village_map[tile] in (-1, 0, 1) else False,
+        ruin = rng.choice(list(filter(lambda tile: True if village_map[tile] in (-1, 0, 1) else False,
                                                 list(range(len(village_map))))))
         terrain = world_map[ruin]['type'];
         if terrain != 'water' and (water_ruins_count < water_ruins_number or terrain != 'ocean'):
@@ -316,7 +407,7 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
     def post_generate(resource, underneath, quantity, capital):
         resources_ = check_resources(resource, capital)
         while resources_ < quantity:
-            pos_ = random.randrange(0, 8)
+            pos_ = rng.randrange(0, 8)
             territory_ = utils.circle(capital, 1, map_size)
             world_map[territory_[pos_]]['type'] = underneath
             world_map[territory_[pos_]]['above'] = resource
@@ -333,7 +424,7 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
         elif world_map[capital]['tribe'] == 'Kickoo':
             resources = check_resources('fish', capital)
             while resources < 2:
-                pos = random.randrange(0, 4)
+                pos = rng.randrange(0, 4)
                 territory = utils.plus_sign(capital, map_size)
                 world_map[territory[pos]]['type'] = 'water'
                 world_map[territory[pos]]['above'] = 'fish'
@@ -358,6 +449,26 @@ def generate(map_size, initial_land, smoothing, relief, tribes, seed=None):
 
 if __name__ == "__main__":
     args = parse_args()
+    if args.count is not None:
+        out = sys.stdout if args.out == '-' else open(args.out, 'w')
+        try:
+            for encoded in generate_batch(
+                args.count,
+                args.size,
+                args.land,
+                args.smooth,
+                args.relief,
+                args.tribes,
+                args.seed,
+                args.workers,
+                args.cache_dir,
+                args.cache_size * 1024 * 1024
+            ):
+                out.write(json.dumps(encoded, separators=(',', ':')) + '\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        sys.exit(0)
     print(json.dumps(
         generate(
             args.size,
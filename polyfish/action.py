@@ -17,8 +17,233 @@ def index_to_coord(index: int, max_size: int) -> Tuple[int, int]:
     x = index % max_size
     return (x, y)
 
+# --- Move Encoding ---
+
+# Prediction heads, in the column order of an encoded move row
+HEAD_KEYS = (
+    'pi_action_logits',
+    'pi_actor_logits',
+    'pi_target_logits',
+    'pi_option_struct_logits',
+    'pi_option_skill_logits',
+    'pi_option_unit_logits',
+    'pi_tech_logits',
+)
+NUM_HEADS = len(HEAD_KEYS)
+
+# PolytopiaNet output keys, aligned with HEAD_KEYS
+NET_HEAD_KEYS = (
+    'pi_action',
+    'pi_source',
+    'pi_target',
+    'pi_struct',
+    'pi_skill',
+    'pi_unit',
+    'pi_tech',
+)
+
+def net_output_to_predictions(output: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """Renames PolytopiaNet outputs to the HEAD_KEYS used for move scoring."""
+    return {key: output[net_key] for key, net_key in zip(HEAD_KEYS, NET_HEAD_KEYS)}
+
+# Move type -> column of its option head
+OPTION_COLUMNS = {
+    'Build':    3,
+    'Ability':  4,
+    'Summon':   5,
+    'Research': 6,
+}
+# MOVE_TYPE index -> option head column, -1 for moves without an option
+_OPTION_COLUMN_BY_ACTION = torch.tensor(
+    [OPTION_COLUMNS.get(name, -1) for name in MOVE_NAMES], dtype=torch.long
+)
+
+def encode_move_indices(move: Dict[str, Any] | int, max_size: int) -> List[int]:
+    """
+    Encodes a move dict or packed move (see gameTypes.encode_move) into one index per head
+    (see HEAD_KEYS), -1 where the head is unused.
+    Moves that cannot be scored (unknown type, missing or invalid fields) have -1 as action index.
+    """
+    row = [-1] * NUM_HEADS
+
+    # TODO ensure compatibility with TS simulator
+    if isinstance(move, dict):
+        try:
+            move = encode_move(move, max_size)
+        except ValueError as e:
+            print(f"Warning: {e}. Assigning -inf prob.")
+            return row
+
+    action, from_index, to_index, option = unpack_move(move)
+    if action == -1:
+        return row
+    row[0], row[1], row[2] = action, from_index, to_index
+    # TODO not all skills are spatial, some require "from", while others "to"
+    column = OPTION_COLUMNS.get(MOVE_NAMES[action])
+    if column is not None:
+        row[column] = option
+    return row
+
+def unpack_move_indices(packed_moves: torch.Tensor) -> torch.Tensor:
+    """
+    Vectorized encode_move_indices for a [B, M] tensor of packed moves, 0 being padding.
+    Returns:
+        [B, M, NUM_HEADS] long tensor.
+    """
+    packed_moves = packed_moves.long()
+    action = (packed_moves >> MOVE_ACTION_SHIFT & MOVE_ACTION_MASK) - 1
+    option = (packed_moves >> MOVE_OPTION_SHIFT & MOVE_OPTION_MASK) - 1
+    option_column = _OPTION_COLUMN_BY_ACTION.to(packed_moves.device)[action.clamp(0, len(MOVE_NAMES) - 1)]
+    columns = [
+        action,
+        (packed_moves >> MOVE_FROM_SHIFT & MOVE_TILE_MASK) - 1,
+        (packed_moves >> MOVE_TO_SHIFT & MOVE_TILE_MASK) - 1,
+    ] + [
+        torch.where(option_column == column, option, -1)
+        for column in range(3, NUM_HEADS)
+    ]
+    return torch.stack(columns, dim=-1)
+
+# MOVE_TYPE index -> HEAD_KEYS columns its moves must set
+_REQUIRED_COLUMNS = torch.tensor([
+    [True, name in ACTOR_MOVES, name in TARGET_MOVES] +
+    [OPTION_COLUMNS.get(name) == column for column in range(3, NUM_HEADS)]
+    for name in MOVE_NAMES
+], dtype=torch.bool)
+
+def check_move_indices(move_indices: torch.Tensor, head_widths: torch.Tensor):
+    """
+    Raises ValueError unless every [..., NUM_HEADS] row of move_indices is scorable: a known
+    action, every field it requires set and every index below its head's width (head_widths,
+    [NUM_HEADS]). Out of range indices would otherwise silently score as the padding column.
+    """
+    rows = move_indices.reshape(-1, NUM_HEADS)
+    if rows.size(0) == 0:
+        return
+    required = _REQUIRED_COLUMNS.to(rows.device)[rows[:, 0].clamp(0, len(MOVE_NAMES) - 1)]
+    invalid = (rows < -1).any(-1) | (rows >= head_widths.to(rows.device)).any(-1) | (required & (rows < 0)).any(-1)
+    if invalid.any():
+        index = int(invalid.nonzero()[0, 0])
+        raise ValueError(f"Move {index} cannot be scored, head indices {rows[index].tolist()} (head sizes {head_widths.tolist()})")
+
+def encode_valid_moves(
+    batch_valid_moves: List[List[Dict[str, Any] | int]],
+    max_size: int,
+    device: torch.device = torch.device('cpu')
+) -> torch.Tensor:
+    """
+    Encodes the valid moves (dicts or packed ints) of a batch of positions into a
+    [B, M, NUM_HEADS] long tensor, M being the largest move count.
+    Padding rows are encoded as unscorable moves.
+    """
+    max_moves = max((len(moves) for moves in batch_valid_moves), default=0)
+
+    if all(isinstance(move, int) for moves in batch_valid_moves for move in moves):
+        # Packed moves skip the per-move dict lookups entirely
+        packed = torch.tensor(
+            [list(moves) + [0] * (max_moves - len(moves)) for moves in batch_valid_moves],
+            dtype=torch.long, device=device
+        ).view(len(batch_valid_moves), max_moves)
+        return unpack_move_indices(packed)
+
+    rows = [
+        [encode_move_indices(move, max_size) for move in moves] +
+        [[-1] * NUM_HEADS] * (max_moves - len(moves))
+        for moves in batch_valid_moves
+    ]
+    return torch.tensor(rows, dtype=torch.long, device=device).view(len(batch_valid_moves), max_moves, NUM_HEADS)
+
 # --- Core Translation Function ---
 
+def score_moves(
+    predictions: Dict[str, torch.Tensor],
+    move_indices: torch.Tensor,
+    temperature: float = 1.0
+) -> torch.Tensor:
+    """
+    Computes the log probability of every encoded move with one gather per head.
+    Args:
+        predictions: Logits keyed by HEAD_KEYS, each [B, D].
+        move_indices: [B, M, NUM_HEADS] tensor from encode_valid_moves.
+    Returns:
+        [B, M] log probabilities, -inf for unscorable and padding moves.
+    """
+    # Apply temperature *before* log_softmax
+    t = max(temperature, 1e-9) # Avoid division by zero if T=0
+    device = move_indices.device
+    batch_size = move_indices.size(0)
+    log_probs = torch.zeros(move_indices.shape[:2], dtype=torch.float32, device=device)
+
+    for column, key in enumerate(HEAD_KEYS):
+        indices = move_indices[..., column]
+        if not (indices >= 0).any():
+            continue
+        log_prob_head = F.log_softmax(predictions[key].to(device).view(batch_size, -1) / t, dim=-1)
+        # Unused heads (-1) point at an extra zero column, contributing log(1)
+        unused = log_prob_head.size(1)
+        log_prob_head = F.pad(log_prob_head, (0, 1))
+        log_probs += log_prob_head.gather(1, torch.where(indices < 0, unused, indices))
+
+    return log_probs.masked_fill(move_indices[..., 0] < 0, -float('inf'))
+
+def move_priors(log_probs: torch.Tensor) -> torch.Tensor:
+    """Normalizes [B, M] move log probabilities into priors, rows without any scorable move are all zero."""
+    return torch.nan_to_num(F.softmax(log_probs, dim=-1), nan=0.0)
+
+def select_moves(
+    log_probs: torch.Tensor,
+    batch_valid_moves: List[List[Dict[str, Any]]],
+    temperature: float = 1.0
+) -> List[Dict[str, Any] | None]:
+    """Picks one move per position from the [B, M] output of score_moves."""
+    selected = []
+    for i, valid_moves in enumerate(batch_valid_moves):
+        if not valid_moves:
+            print("Warning: No valid moves provided.")
+            selected.append(None) # Or potentially return a default 'EndTurn' action if appropriate
+            continue
+
+        action_log_probs = log_probs[i, :len(valid_moves)]
+
+        if torch.all(action_log_probs == -float('inf')):
+            print("Warning: All valid moves received -inf probability. Selecting randomly.")
+            # Fallback: If all moves somehow got invalid scores, choose randomly
+            # This might indicate a problem in the mappings or network outputs
+            selected.append(random.choice(valid_moves))
+            continue
+
+        if temperature <= 1e-9: # Argmax selection (Greedy)
+            best_move_idx = torch.argmax(action_log_probs).item()
+        else: # Probabilistic sampling
+            action_probs = F.softmax(action_log_probs, dim=0) # Normalize log_probs into probabilities
+            # Check for NaNs which can occur if softmax underflows/overflows (less likely with log_softmax start)
+            if torch.isnan(action_probs).any():
+                print(f"Warning: NaNs detected in action probabilities after softmax. Log Probs: {action_log_probs}. Falling back to random choice.")
+                # Fallback to random choice among those that didn't have -inf log_prob initially
+                valid_indices = [j for j, lp in enumerate(action_log_probs.tolist()) if not math.isinf(lp)]
+                selected.append(valid_moves[random.choice(valid_indices)])
+                continue
+            best_move_idx = torch.multinomial(action_probs, num_samples=1).item()
+
+        selected.append(valid_moves[best_move_idx])
+    return selected
+
+def translate_predictions_to_moves(
+    predictions: Dict[str, torch.Tensor],
+    batch_valid_moves: List[List[Dict[str, Any]]],
+    max_size: int,
+    temperature: float = 1.0,
+    device: torch.device = torch.device('cpu')
+) -> List[Dict[str, Any] | None]:
+    """
+    Batched translate_prediction_to_move, predictions hold one row per position.
+    Returns:
+        The selected Action dictionary for each position, None where no valid moves are available.
+    """
+    move_indices = encode_valid_moves(batch_valid_moves, max_size, device)
+    log_probs = score_moves(predictions, move_indices, temperature)
+    return select_moves(log_probs, batch_valid_moves, temperature)
+
 def translate_prediction_to_move(
     predictions: Dict[str, torch.Tensor],
     valid_moves: List[Dict[str, Any]],
@@ -31,153 +256,48 @@ def translate_prediction_to_move(
     Returns:
         The selected Action dictionary, or None if no valid moves are available.
     """
-    if not valid_moves:
-        print("Warning: No valid moves provided.")
-        return None # Or potentially return a default 'EndTurn' action if appropriate
+    return translate_predictions_to_moves(predictions, [valid_moves], max_size, temperature, device)[0]
 
-    num_valid_moves = len(valid_moves)
-    action_log_probs = torch.full((num_valid_moves,), -float('inf'), dtype=torch.float32, device=device)
+# --- Training Targets ---
 
-    # --- Pre-calculate log probabilities for all components ---
-    # Use log_softmax for numerical stability
-    # Apply temperature *before* log_softmax
-    # Ensure logits are on the correct device BEFORE operations
-    t = max(temperature, 1e-9) # Avoid division by zero if T=0
-
-    log_prob_action_type = F.log_softmax(predictions['pi_action_logits'].to(device) / t, dim=-1).squeeze(0) # Assuming batch size 1
-    log_prob_actor       = F.log_softmax(predictions['pi_actor_logits'].to(device) / t, dim=-1).squeeze(0)
-    log_prob_target      = F.log_softmax(predictions['pi_target_logits'].to(device) / t, dim=-1).squeeze(0)
-    log_prob_struct      = F.log_softmax(predictions['pi_option_struct_logits'].to(device) / t, dim=-1).squeeze(0)
-    log_prob_skill       = F.log_softmax(predictions['pi_option_skill_logits'].to(device) / t, dim=-1).squeeze(0)
-    log_prob_unit        = F.log_softmax(predictions['pi_option_unit_logits'].to(device) / t, dim=-1).squeeze(0)
-    log_prob_tech        = F.log_softmax(predictions['pi_tech_logits'].to(device) / t, dim=-1).squeeze(0)
-
-    # --- Calculate log probability for each valid move ---
-    for i, move in enumerate(valid_moves):
-        current_move_log_prob = 0.0
-
-        # 1. Action Type Probability
-        move_type_str = move.get('action', 'None')
-        move_type_idx = MOVE_TYPE.get(move_type_str, -1)
-        if move_type_idx == -1:
-             print(f"Warning: Unknown MoveType '{move_type_str}' in valid_moves. Skipping.")
-             continue # Skip this invalid move description
-        current_move_log_prob += log_prob_action_type[move_type_idx]
-
-        # --- Add probabilities for required components based on move type ---
-
-        # TODO ensure compatibility with TS simulator
-        
-        # 2. Actor ('from') Probability
-        if move_type_str in ['Step', 'Attack', 'Ability', 'Capture']:
-            from_coord = move.get('from')
-            if from_coord:
-                actor_idx = coord_to_index(tuple(from_coord), max_size)
-                current_move_log_prob += log_prob_actor[actor_idx]
-            else:
-                print(f"Warning: Move '{move_type_str}' requires 'from' but not found. Assigning -inf prob.")
-                current_move_log_prob = -float('inf') # Invalid move structure
-
-        # 3. Target ('to') Probability
-        if move_type_str in ['Step', 'Attack', 'Ability', 'Summon', 'Harvest', 'Build']:
-            to_coord = move.get('to')
-            if to_coord:
-                target_idx = coord_to_index(tuple(to_coord), max_size)
-                current_move_log_prob += log_prob_target[target_idx]
-            else:
-                print(f"Warning: Move '{move_type_str}' requires 'to' but not found. Assigning -inf prob.")
-                current_move_log_prob = -float('inf')
-
-        # 4. Structure Probability
-        if move_type_str == 'Build':
-            struct_type_str = move.get('struct', 'None')
-            struct_idx = BUILD_TYPE.get(struct_type_str, -1)
-            if struct_idx != -1:
-                current_move_log_prob += log_prob_struct[struct_idx]
-            else:
-                 print(f"Warning: Move '{move_type_str}' requires valid 'struct' but found '{struct_type_str}'. Assigning -inf prob.")
-                 current_move_log_prob = -float('inf')
-
-        # 5. Ability/Skill Probability
-        # TODO not all skills are spatial, some require "from", while others "to"
-        if move_type_str == 'Ability':
-            ability_type_str = move.get('ability', 'None')
-            ability_idx = ABILITY_TYPE.get(ability_type_str, -1)
-            if ability_idx != -1:
-                 current_move_log_prob += log_prob_skill[ability_idx]
-            else:
-                 print(f"Warning: Move '{move_type_str}' requires valid 'ability' but found '{ability_type_str}'. Assigning -inf prob.")
-                 current_move_log_prob = -float('inf')
-
-        # 6. Unit Probability
-        if move_type_str == 'Summon':
-             unit_type_str = move.get('unit', 'None')
-             unit_idx = SUMMON_TYPE.get(unit_type_str, -1)
-             if unit_idx != -1:
-                 current_move_log_prob += log_prob_unit[unit_idx]
-             else:
-                 print(f"Warning: Move '{move_type_str}' requires valid 'unit' but found '{unit_type_str}'. Assigning -inf prob.")
-                 current_move_log_prob = -float('inf')
-
-        # 7. Technology Probability
-        if move_type_str == 'Research':
-            tech_type_str = move.get('tech', 'None')
-            tech_idx = TECHNOLOGY_TYPE.get(tech_type_str, -1)
-            if tech_idx != -1:
-                current_move_log_prob += log_prob_tech[tech_idx]
-            else:
-                 print(f"Warning: Move '{move_type_str}' requires valid 'tech' but found '{tech_type_str}'. Assigning -inf prob.")
-                 current_move_log_prob = -float('inf')
-
-        # --- Store the calculated log probability ---
-        # Only store if it's not -inf (meaning the move structure was valid)
-        if not math.isinf(current_move_log_prob):
-             action_log_probs[i] = current_move_log_prob
-
-    # --- Select Move ---
-    if torch.all(action_log_probs == -float('inf')):
-        print("Warning: All valid moves received -inf probability. Selecting randomly.")
-        # Fallback: If all moves somehow got invalid scores, choose randomly
-        # This might indicate a problem in the mappings or network outputs
-        return random.choice(valid_moves) if valid_moves else None
-
-    if temperature <= 1e-9: # Argmax selection (Greedy)
-        best_move_idx = torch.argmax(action_log_probs).item()
-    else: # Probabilistic sampling
-        # Use torch.multinomial which expects log-probabilities or probabilities
-        # It's safer to work with probabilities here after calculating log probs
-        action_probs = F.softmax(action_log_probs, dim=0) # Normalize log_probs into probabilities
-        # Check for NaNs which can occur if all log_probs were -inf (handled above)
-        # or if softmax underflows/overflows (less likely with log_softmax start)
-        if torch.isnan(action_probs).any():
-            print(f"Warning: NaNs detected in action probabilities after softmax. Log Probs: {action_log_probs}. Falling back to random choice.")
-            # Fallback to random choice among those that didn't have -inf log_prob initially
-            valid_indices = [i for i, lp in enumerate(action_log_probs.tolist()) if not math.isinf(lp)]
-            if not valid_indices: return random.choice(valid_moves) # Should not happen if initial check passed
-            chosen_idx = random.choice(valid_indices)
-            return valid_moves[chosen_idx]
-
-        best_move_idx = torch.multinomial(action_probs, num_samples=1).item()
-
-    return valid_moves[best_move_idx]
+def policy_targets(moves: List[int], probs: List[float], config: dict) -> Dict[str, List[float]]:
+    """
+    Marginalizes a distribution over packed moves into per head policy targets,
+    keyed and sized like the PolytopiaNet outputs.
+    """
+    dims = (
+        config['dim_moves'],
+        config['dim_map_size'] ** 2,
+        config['dim_map_size'] ** 2,
+        config['dim_struct'],
+        config['dim_ability'],
+        config['dim_unit'],
+        config['dim_tech'],
+    )
+    targets = {key: [0.0] * dim for key, dim in zip(NET_HEAD_KEYS, dims)}
+    for move, prob in zip(moves, probs):
+        for key, index in zip(NET_HEAD_KEYS, encode_move_indices(move, config['dim_map_size'])):
+            if index >= 0:
+                targets[key][index] += prob
+    return targets
 
 # --- Example Usage ---
 if __name__ == '__main__':
     # --- Dummy Data Setup ---
-    MAP_SIZE = 5 ** 2
+    MAP_SIZE = 5
     DIM_ACTION = MOVE_TYPE['_MAX_N']
     DIM_STRUCT = BUILD_TYPE['_MAX_N']
     DIM_SKILL  = ABILITY_TYPE['_MAX_N']
     DIM_UNIT   = SUMMON_TYPE['_MAX_N']
     DIM_TECH   = TECHNOLOGY_TYPE['_MAX_N']
-    BATCH_SIZE = 1 # This function assumes batch size 1 for predictions
+    BATCH_SIZE = 1 # translate_prediction_to_move assumes batch size 1 for predictions
     DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     # 1. Dummy Network Predictions (Logits)
     dummy_predictions = {
         'pi_action_logits': torch.randn(BATCH_SIZE, DIM_ACTION, device=DEVICE),
-        'pi_actor_logits': torch.randn(BATCH_SIZE, MAP_SIZE, device=DEVICE),
-        'pi_target_logits': torch.randn(BATCH_SIZE, MAP_SIZE, device=DEVICE),
+        'pi_actor_logits': torch.randn(BATCH_SIZE, MAP_SIZE ** 2, device=DEVICE),
+        'pi_target_logits': torch.randn(BATCH_SIZE, MAP_SIZE ** 2, device=DEVICE),
         'pi_option_struct_logits': torch.randn(BATCH_SIZE, DIM_STRUCT, device=DEVICE),
         'pi_option_skill_logits': torch.randn(BATCH_SIZE, DIM_SKILL, device=DEVICE),
         'pi_option_unit_logits': torch.randn(BATCH_SIZE, DIM_UNIT, device=DEVICE),
@@ -210,6 +330,13 @@ if __name__ == '__main__':
     )
     print(f"Selected Move: {selected_move_sample}")
 
+    # Batched: the same logits scored for several positions at once
+    batch_predictions = {key: dummy_predictions[key].expand(3, -1) for key in HEAD_KEYS}
+    batch_valid_moves = [dummy_valid_moves, dummy_valid_moves[:2], []]
+    print("Batched Moves:", translate_predictions_to_moves(
+        batch_predictions, batch_valid_moves, MAP_SIZE, temperature=1.0, device=DEVICE
+    ))
+
     # print("\n--- Selecting Move (Temperature = 0.0 - Argmax/Greedy) ---")
     # selected_move_greedy = translate_prediction_to_move(
     #     dummy_predictions, dummy_valid_moves, MAP_WIDTH, MAP_HEIGHT, temperature=0.0, device=DEVICE
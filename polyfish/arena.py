@@ -0,0 +1,128 @@
+import queue
+import numpy as np
+import torch
+import multiprocessing as mp
+from game import StandInGame
+from mcts import MCTS
+from selfplay import QueueEvaluator, inference_server, WORKER_THREADS
+from predictor import MAX_BATCH, MAX_DELAY
+
+# Arena games always use the same seeds so win rates are comparable across iterations
+ARENA_SEED = 0
+
+CANDIDATE = 0
+BEST = 1
+
+def play_arena_game(game, players: dict, seed: int, max_moves: int = 2000) -> float:
+    """
+    Plays one game, players mapping each game player to its MCTS.
+    Returns:
+        The outcome in [-1, 1] for game player 0, 0 if the game hit max_moves.
+    """
+    state = game.initial_state(seed)
+    for _ in range(max_moves):
+        if game.is_terminal(state):
+            value = game.terminal_value(state)
+            return value if game.current_player(state) == 0 else -value
+        move, _, _ = players[game.current_player(state)].select_move(state)
+        if move is None:
+            break
+        state = game.step(state, move)
+    return 0.0
+
+def _arena_worker(worker_id, config, mcts_settings, task_queue, result_queue, request_queues, response_queues):
+    torch.set_num_threads(WORKER_THREADS)
+    game = StandInGame(config)
+    searches = [
+        MCTS(game, QueueEvaluator(worker_id, request_queues[side], response_queues[side]), **mcts_settings)
+        for side in (CANDIDATE, BEST)
+    ]
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        seed, candidate_player = task
+        for search in searches:
+            search.rng = np.random.default_rng(seed)
+        players = {
+            candidate_player: searches[CANDIDATE],
+            1 - candidate_player: searches[BEST],
+        }
+        outcome = play_arena_game(game, players, seed)
+        result_queue.put(outcome if candidate_player == 0 else -outcome)
+
+def evaluate_candidate(
+    candidate, best, config: dict, n_games: int, n_workers: int,
+    n_sims: int, cPuct: float, batch_size: int = 32, base_seed: int = ARENA_SEED,
+    max_batch: int = MAX_BATCH, max_delay: float = MAX_DELAY,
+) -> float:
+    """
+    Plays candidate against best over n_games seeded StandInGame positions, the game the
+    local self-play trains on, swapping sides every game.
+    Moves are picked greedily without root noise, each net being served by its own
+    batched inference process.
+    Returns:
+        The candidate score rate, draws counting as half a win.
+    """
+    n_workers = max(1, min(n_workers, n_games))
+    ctx = mp.get_context('spawn')
+
+    request_queues = [ctx.Queue() for _ in (CANDIDATE, BEST)]
+    response_queues = [[ctx.Queue() for _ in (CANDIDATE, BEST)] for _ in range(n_workers)]
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+
+    servers = [
+        ctx.Process(
+            target=inference_server,
+            args=(
+                {key: value.cpu() for key, value in net.state_dict().items()},
+                config, len(net.res_blocks), request_queues[side],
+                [queues[side] for queues in response_queues], max_batch, max_delay
+            ),
+            daemon=True
+        )
+        for side, net in ((CANDIDATE, candidate), (BEST, best))
+    ]
+    mcts_settings = {
+        'n_sims': n_sims, 'cPuct': cPuct, 'temperature': 0.0,
+        'dirichlet': False, 'batch_size': batch_size,
+    }
+    workers = [
+        ctx.Process(
+            target=_arena_worker,
+            args=(i, config, mcts_settings, task_queue, result_queue, request_queues, response_queues[i]),
+            daemon=True
+        )
+        for i in range(n_workers)
+    ]
+
+    for i in range(n_games):
+        task_queue.put((base_seed + i // 2, i % 2))
+    for _ in workers:
+        task_queue.put(None)
+
+    for process in servers + workers:
+        process.start()
+
+    score = 0.0
+    finished = 0
+    try:
+        while finished < n_games:
+            try:
+                outcome = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not all(server.is_alive() for server in servers) or not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError(f"Arena died after {finished}/{n_games} games")
+                continue
+            score += (outcome + 1) / 2
+            finished += 1
+    finally:
+        for request_queue in request_queues:
+            request_queue.put(None)
+        for process in workers + servers:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+
+    return score / n_games
@@ -0,0 +1,109 @@
+import json
+import queue
+import socket
+import threading
+
+# Client for the socket mode of main.py (see server.py), no torch needed.
+# Addresses are 'tcp://host:port' or 'unix:///path/to.sock'.
+
+def parse_address(address: str) -> tuple[str, str | tuple[str, int]]:
+    """
+    Returns:
+        ('unix', path) or ('tcp', (host, port))
+    """
+    if address.startswith('unix://'):
+        return 'unix', address[len('unix://'):]
+    if address.startswith('tcp://'):
+        address = address[len('tcp://'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+def _to_json(value):
+    # numpy arrays and scalars
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class _Connection:
+    def __init__(self, address: str, timeout: float | None):
+        family, target = parse_address(address)
+        if family == 'unix':
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(timeout)
+        self.sock.connect(target)
+        self.reader = self.sock.makefile('rb')
+        self.next_id = 0
+
+    def request(self, data: dict) -> dict:
+        self.next_id += 1
+        self.sock.sendall(json.dumps({ **data, 'id': self.next_id }, default=_to_json).encode() + b'\n')
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Inference server closed the connection")
+        return json.loads(line)
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+class PredictorClient:
+    """
+    Blocking, thread safe client keeping up to pool_size connections open.
+    Each call holds one connection, so pool_size bounds the requests in flight.
+    """
+    def __init__(self, address: str, pool_size: int = 4, timeout: float | None = None):
+        self.address = address
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.idle = queue.LifoQueue()
+
+    def predict(self, map_obs, player, heads: list[str] | None = None, moves: list | None = None) -> dict:
+        """map_obs dense [C, S, S] or sparse (see obs.py), with moves the result holds 'priors'."""
+        data = { 'cmd': 'predict', 'map': map_obs, 'player': player }
+        if heads is not None:
+            data['heads'] = heads
+        if moves is not None:
+            data['moves'] = moves
+        return self.request(data)
+
+    def predict_batch(self, observations: list[dict], heads: list[str] | None = None) -> list[dict]:
+        """observations: [{ 'map', 'player', 'moves'? }, ...]"""
+        data = { 'cmd': 'predict_batch', 'observations': observations }
+        if heads is not None:
+            data['heads'] = heads
+        return self.request(data)
+
+    def stats(self) -> dict:
+        return self.request({ 'cmd': 'stats' })
+
+    def request(self, data: dict):
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                connection = _Connection(self.address, self.timeout)
+            try:
+                reply = connection.request(data)
+            except Exception:
+                connection.close()
+                raise
+            self.idle.put(connection)
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply['result']
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
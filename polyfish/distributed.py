@@ -0,0 +1,143 @@
+import os
+import json
+import random
+import logging
+import argparse
+from datetime import timedelta
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# Data-parallel training over CPU processes (see model.train_network / model.self_train).
+# Rank 0 plays the games and writes the checkpoints, every rank trains on its share of the
+# samples and the gradients are averaged over all of them before each optimizer step.
+#
+# One box, 4 processes:
+#   python distributed.py --nprocs 4 --options '{"iterations": 10, "workers": 8}'
+# Several nodes, started on each of them with torchrun:
+#   torchrun --nnodes 2 --nproc-per-node 4 --rdzv-backend c10d --rdzv-endpoint host:29500 distributed.py
+
+BACKEND = 'gloo'
+MASTER_ADDRESS = '127.0.0.1:29500'
+# Ranks 1..N wait in a collective while rank 0 plays a whole iteration of games and runs the
+# arena, gloo's 30 minute default is easily exceeded
+TIMEOUT_MINUTES = 12 * 60
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+def world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main() -> bool:
+    return rank() == 0
+
+def init(rank: int | None = None, world_size: int | None = None, address: str | None = None, timeout_minutes: float = TIMEOUT_MINUTES):
+    """
+    Joins the gloo process group, rank and world_size unset read torchrun's RANK,
+    WORLD_SIZE, MASTER_ADDR and MASTER_PORT.
+    Only rank 0 keeps logging below warnings.
+    """
+    timeout = timedelta(minutes=timeout_minutes)
+    if rank is None:
+        dist.init_process_group(BACKEND, init_method='env://', timeout=timeout)
+    else:
+        dist.init_process_group(BACKEND, init_method=f"tcp://{address or MASTER_ADDRESS}", rank=rank, world_size=world_size, timeout=timeout)
+    if not is_main():
+        logging.getLogger().setLevel(logging.WARNING)
+
+def shutdown():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def broadcast_object(value, src: int = 0):
+    """Returns rank src's value on every rank, value is ignored elsewhere (pickled)."""
+    if not is_distributed():
+        return value
+    holder = [value]
+    dist.broadcast_object_list(holder, src=src)
+    return holder[0]
+
+def broadcast_state(net: torch.nn.Module, src: int = 0):
+    """Overwrites the parameters and buffers (BatchNorm stats) with rank src's."""
+    with torch.no_grad():
+        for tensor in net.state_dict().values():
+            dist.broadcast(tensor, src=src)
+    net.weights_version += 1
+
+def shard(dataset: list) -> list:
+    """
+    Splits the dataset, identical on every rank, into world_size disjoint shares in a
+    random order drawn by rank 0. Shares are cut to the same length so every rank runs the
+    same number of steps, and so the same number of all-reduces.
+    """
+    order = list(range(len(dataset)))
+    random.Random(broadcast_object(random.getrandbits(64))).shuffle(order)
+    per_rank = len(dataset) // world_size()
+    return [dataset[i] for i in order[rank()::world_size()][:per_rank]]
+
+def all_reduce_gradients(net: torch.nn.Module):
+    """
+    Averages the gradients over all ranks in one flat all-reduce, after agreeing on which exist.
+    A gradient missing on some ranks (no loss reaching it in the step) counts as zeros there,
+    one missing on every rank stays None so the optimizer leaves its parameter alone.
+    """
+    parameters = [p for p in net.parameters() if p.requires_grad]
+    present = torch.tensor([float(p.grad is not None) for p in parameters])
+    dist.all_reduce(present, op=dist.ReduceOp.MAX)
+    parameters = [p for p, anywhere in zip(parameters, present.tolist()) if anywhere]
+    if not parameters:
+        return
+    flat = torch.cat([
+        (p.grad if p.grad is not None else torch.zeros_like(p)).reshape(-1) for p in parameters
+    ])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= world_size()
+    offset = 0
+    for p in parameters:
+        n = p.numel()
+        p.grad = flat[offset : offset + n].view_as(p).clone()
+        offset += n
+
+def _train(local_rank: int, world_size: int | None, address: str | None, threads: int, timeout_minutes: float, model_path: str, options: dict):
+    import model
+    import serving
+
+    # Before init lowers the level on ranks other than 0
+    model.setup_logging()
+    # Without world_size the group comes from torchrun's environment
+    init(local_rank if world_size else None, world_size, address, timeout_minutes)
+    # Disjoint cores per process on the box. Not for rank 0: the self-play and arena processes
+    # it spawns inherit its affinity, and should spread over every core
+    serving.apply_serving_config(threads, 0, '', local_rank if threads > 0 and not is_main() else None)
+    try:
+        with open('data/model/config.json', 'r') as f:
+            config = json.load(f)
+            config['max_tile_count'] = config['dim_map_size'] ** 2
+        net = model.load(model_path + '-latest', config, config.get('res_blocks', 12))
+        model.self_train(net, filename=model_path + options.get('prefix', ''), config=config, **model.train_options(options))
+    finally:
+        shutdown()
+
+def launch(nprocs: int, threads: int, model_path: str, options: dict, address: str | None = None, timeout_minutes: float = TIMEOUT_MINUTES):
+    """Runs self_train as nprocs local processes, the whole group on this box."""
+    mp.spawn(_train, args=(nprocs, address, threads, timeout_minutes, model_path, options), nprocs=nprocs, join=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Data-parallel self-training over gloo.")
+    parser.add_argument('--nprocs', type=int, default=1, help='Local processes to spawn, ignored under torchrun')
+    parser.add_argument('--threads', type=int, default=0, help='Intra-op threads per process, also pins each to its own cores')
+    parser.add_argument('--address', type=str, default=MASTER_ADDRESS, help='host:port of rank 0 for --nprocs')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT_MINUTES, help='Minutes a rank waits in a collective, covering a whole self-play phase')
+    parser.add_argument('--model', type=str, default='models/polyfish')
+    parser.add_argument('--options', type=str, default='{}', help="Train command options as JSON, see main.py's 'train'")
+    args = parser.parse_args()
+    options = json.loads(args.options)
+
+    if 'RANK' in os.environ:
+        _train(int(os.environ.get('LOCAL_RANK', 0)), None, None, args.threads, args.timeout, args.model, options)
+    else:
+        launch(args.nprocs, args.threads, args.model, options, args.address, args.timeout)
@@ -0,0 +1,134 @@
+import random
+import numpy as np
+from gameTypes import *
+
+class GameInterface:
+    """
+    Game-step interface driven by the python MCTS.
+    States are treated as immutable, step returns a new state.
+    Moves are packed ints (see gameTypes.encode_move).
+    """
+    def initial_state(self, seed: int | None = None):
+        raise NotImplementedError
+
+    def current_player(self, state) -> int:
+        raise NotImplementedError
+
+    def legal_moves(self, state) -> list[int]:
+        raise NotImplementedError
+
+    def step(self, state, move: int):
+        raise NotImplementedError
+
+    def is_terminal(self, state) -> bool:
+        raise NotImplementedError
+
+    def terminal_value(self, state) -> float:
+        """Outcome in [-1, 1] from the perspective of current_player(state)."""
+        raise NotImplementedError
+
+    def reward(self, state, move: int, next_state) -> float:
+        """Immediate reward of move for current_player(state), none by default."""
+        return 0.0
+
+    def observe(self, state) -> dict:
+        """Observation of current_player(state), {'map': [C, S, S], 'player': [P]} float32 arrays."""
+        raise NotImplementedError
+
+class StandInGame(GameInterface):
+    """
+    Small two player stand-in for the TS simulator, shaped like the real observations.
+    Each player owns a unit and per turn can research, step its unit once, and end the turn.
+    The player with the most researched techs after max_turns wins.
+    """
+    def __init__(self, config: dict, max_turns: int | None = None, tech_cost: int = 5, income: int = 3):
+        self.config = config
+        self.size = config['dim_map_size']
+        self.max_turns = max_turns or config['max_turns']
+        self.tech_cost = tech_cost
+        self.income = income
+
+    def initial_state(self, seed=None):
+        rng = random.Random(seed)
+        tiles = rng.sample(range(self.size ** 2), 2)
+        return {
+            'turn': 0,
+            'player': 0,
+            'stars': (self.income, self.income),
+            'techs': (frozenset(), frozenset()),
+            'units': tuple(tiles),
+            'moved': False,
+            'terrain': tuple(rng.randrange(4) for _ in range(self.size ** 2)),
+        }
+
+    def current_player(self, state):
+        return state['player']
+
+    def legal_moves(self, state):
+        player = state['player']
+        moves = [pack_move(MOVE_TYPE['EndTurn'])]
+        if state['stars'][player] >= self.tech_cost:
+            moves += [
+                pack_move(MOVE_TYPE['Research'], option=tech)
+                for tech in range(TECHNOLOGY_TYPE['_MAX_N'])
+                if tech not in state['techs'][player]
+            ]
+        if state['moved']:
+            return moves
+        unit = state['units'][player]
+        for neighbour in self._neighbours(unit):
+            if neighbour not in state['units']:
+                moves.append(pack_move(MOVE_TYPE['Step'], unit, neighbour))
+        return moves
+
+    def step(self, state, move):
+        action, from_index, to_index, option = unpack_move(move)
+        player = state['player']
+        state = dict(state)
+        if action == MOVE_TYPE['Research']:
+            state['stars'] = self._set(state['stars'], player, state['stars'][player] - self.tech_cost)
+            state['techs'] = self._set(state['techs'], player, state['techs'][player] | {option})
+        elif action == MOVE_TYPE['Step']:
+            state['units'] = self._set(state['units'], player, to_index)
+            state['moved'] = True
+        elif action == MOVE_TYPE['EndTurn']:
+            state['player'] = 1 - player
+            state['moved'] = False
+            if state['player'] == 0:
+                state['turn'] += 1
+            state['stars'] = self._set(state['stars'], state['player'], state['stars'][state['player']] + self.income)
+        return state
+
+    def is_terminal(self, state):
+        return state['turn'] >= self.max_turns
+
+    def terminal_value(self, state):
+        player = state['player']
+        mine, theirs = len(state['techs'][player]), len(state['techs'][1 - player])
+        return float(np.sign(mine - theirs))
+
+    def observe(self, state):
+        player = state['player']
+        obs_map = np.zeros((self.config['dim_map_channels'], self.size, self.size), dtype=np.float32)
+        for index, terrain in enumerate(state['terrain']):
+            obs_map[terrain, index // self.size, index % self.size] = 1
+        for owner, unit in enumerate(state['units']):
+            obs_map[4 + (owner != player), unit // self.size, unit % self.size] = 1
+        obs_player = np.zeros(self.config['dim_player'], dtype=np.float32)
+        obs_player[0] = state['stars'][player] / self.config['max_stars']
+        obs_player[1] = state['turn'] / self.max_turns
+        for tech in state['techs'][player]:
+            obs_player[2 + tech % (len(obs_player) - 2)] = 1
+        return { 'map': obs_map, 'player': obs_player }
+
+    def _neighbours(self, index):
+        x, y = index % self.size, index // self.size
+        return [
+            ny * self.size + nx
+            for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1))
+            if 0 <= nx < self.size and 0 <= ny < self.size
+        ]
+
+    @staticmethod
+    def _set(values: tuple, index: int, value):
+        return tuple(value if i == index else v for i, v in enumerate(values))
@@ -175,3 +175,115 @@ REWARD_TYPE = {
     'Park':             7,
     '_MAX_N':           8,
 }
+
+# --- Packed Move Encoding ---
+# A move packs into one int, each field holding its index + 1 (0 = unused):
+#   bits  0-3   action   MOVE_TYPE
+#   bits  4-15  from     tile index
+#   bits 16-27  to       tile index
+#   bits 28-33  option   index into the table of OPTION_TYPE[action]
+
+MOVE_ACTION_SHIFT = 0
+MOVE_FROM_SHIFT   = 4
+MOVE_TO_SHIFT     = 16
+MOVE_OPTION_SHIFT = 28
+
+MOVE_ACTION_MASK  = 0xF
+MOVE_TILE_MASK    = 0xFFF
+MOVE_OPTION_MASK  = 0x3F
+
+# Move types that require an actor ('from') or a target ('to') tile
+ACTOR_MOVES = ('Step', 'Attack', 'Ability', 'Capture')
+TARGET_MOVES = ('Step', 'Attack', 'Ability', 'Summon', 'Harvest', 'Build')
+
+# Move type -> (move key, lookup table) of its option
+OPTION_TYPE = {
+    'Build':    ('struct',  BUILD_TYPE),
+    'Ability':  ('ability', ABILITY_TYPE),
+    'Summon':   ('unit',    SUMMON_TYPE),
+    'Research': ('tech',    TECHNOLOGY_TYPE),
+}
+
+def type_names(table: dict) -> list:
+    """Index -> name list of a categorical table, ignoring unmapped (-1) names."""
+    names = [None] * table['_MAX_N']
+    for name, index in table.items():
+        if index >= 0 and name != '_MAX_N':
+            names[index] = name
+    return names
+
+MOVE_NAMES = type_names(MOVE_TYPE)
+OPTION_NAMES = {action: type_names(table) for action, (_, table) in OPTION_TYPE.items()}
+
+def _check_field(name: str, value: int, mask: int, required: bool = False):
+    if not (0 if required else -1) <= value < mask:
+        raise ValueError(f"Move field '{name}' out of range: {value}")
+
+def pack_move(action: int, from_index: int = -1, to_index: int = -1, option: int = -1) -> int:
+    """Raises ValueError if a field does not fit its bits (and would corrupt its neighbour)."""
+    _check_field('action', action, MOVE_ACTION_MASK, required=True)
+    _check_field('from', from_index, MOVE_TILE_MASK)
+    _check_field('to', to_index, MOVE_TILE_MASK)
+    _check_field('option', option, MOVE_OPTION_MASK)
+    return (
+        (action + 1) << MOVE_ACTION_SHIFT |
+        (from_index + 1) << MOVE_FROM_SHIFT |
+        (to_index + 1) << MOVE_TO_SHIFT |
+        (option + 1) << MOVE_OPTION_SHIFT
+    )
+
+def unpack_move(packed: int) -> tuple:
+    """Returns (action, from_index, to_index, option), -1 for unused fields."""
+    return (
+        (packed >> MOVE_ACTION_SHIFT & MOVE_ACTION_MASK) - 1,
+        (packed >> MOVE_FROM_SHIFT & MOVE_TILE_MASK) - 1,
+        (packed >> MOVE_TO_SHIFT & MOVE_TILE_MASK) - 1,
+        (packed >> MOVE_OPTION_SHIFT & MOVE_OPTION_MASK) - 1,
+    )
+
+def _tile_index(move: dict, key: str, max_size: int) -> int:
+    x, y = move[key]
+    if not (0 <= x < max_size and 0 <= y < max_size):
+        raise ValueError(f"Move '{key}' tile {move[key]} outside a {max_size}x{max_size} map")
+    return y * max_size + x
+
+def encode_move(move: dict, max_size: int) -> int:
+    """Packs a move dict, raises ValueError if it is unknown, off the map or misses a required field."""
+    action_str = move.get('action', 'None')
+    action = MOVE_TYPE.get(action_str, -1)
+    if action == -1:
+        raise ValueError(f"Unknown MoveType '{action_str}'")
+
+    from_index = to_index = option = -1
+    if action_str in ACTOR_MOVES:
+        if not move.get('from'):
+            raise ValueError(f"Move '{action_str}' requires 'from' but not found")
+        from_index = _tile_index(move, 'from', max_size)
+    if action_str in TARGET_MOVES:
+        if not move.get('to'):
+            raise ValueError(f"Move '{action_str}' requires 'to' but not found")
+        to_index = _tile_index(move, 'to', max_size)
+    if action_str in OPTION_TYPE:
+        key, table = OPTION_TYPE[action_str]
+        option = table.get(move.get(key, 'None'), -1)
+        if option == -1:
+            raise ValueError(f"Move '{action_str}' requires valid '{key}' but found '{move.get(key, 'None')}'")
+
+    return pack_move(action, from_index, to_index, option)
+
+def decode_move(packed: int, max_size: int) -> dict:
+    """Raises ValueError on an unknown action or option code (0, the padding move, included)."""
+    action, from_index, to_index, option = unpack_move(packed)
+    action_str = MOVE_NAMES[action] if 0 <= action < len(MOVE_NAMES) else None
+    if action_str is None:
+        raise ValueError(f"Unknown move action code {action} in {packed}")
+    if option >= 0 and (action_str not in OPTION_TYPE or option >= len(OPTION_NAMES[action_str]) or OPTION_NAMES[action_str][option] is None):
+        raise ValueError(f"Unknown option code {option} for '{action_str}' in {packed}")
+    move = { 'action': action_str }
+    if from_index >= 0:
+        move['from'] = [from_index % max_size, from_index // max_size]
+    if to_index >= 0:
+        move['to'] = [to_index % max_size, to_index // max_size]
+    if option >= 0:
+        move[OPTION_TYPE[action_str][0]] = OPTION_NAMES[action_str][option]
+    return move
@@ -1,95 +1,119 @@
-import numpy as np
-import torch, json
-import torch.nn.functional as F
-import json, torch, sys, os
+import time
+startup_start = time.perf_counter()
+
+import json, sys
 import threading
+import argparse
 import model
-from predictor import PredictorBatcher
-
-with open('data/model/config.json', 'r') as f:
-    config = json.load(f)
-    config['max_tile_count'] = config['dim_map_size'] ** 2
-
-root_path = 'models/polyfish'
-prefix = ''
-net = model.load(root_path + '-latest', config)
-training = False
-train_thread = None
-predictor = PredictorBatcher(net)
+from predictor import PredictorBatcher, FEATURE_CACHE_SIZE, MAX_QUEUE
+from metrics import metrics
+import serving
+from server import InferenceServer, obs_to_tensor, parse_predict
 
 def reply(data):
-    sys.stdout.write(json.dumps(data))
+    sys.stdout.write(json.dumps(data) + '\n')
     sys.stdout.flush()
 
-def obs_to_tensor(value: dict):
-    return {
-        'map': torch.tensor(np.array(value['map'])).to(model.device).unsqueeze(0).float(),
-        'player': torch.tensor(np.array(value['player'])).to(model.device).unsqueeze(0).float()
-    }
+# Self-play and arena workers are spawned, and re-import this file as __mp_main__
+def main():
+    with open('data/model/config.json', 'r') as f:
+        config = json.load(f)
+        config['max_tile_count'] = config['dim_map_size'] ** 2
+
+    parser = argparse.ArgumentParser(description="Polyfish predictor and trainer process.")
+    serving.add_serving_args(parser, config)
+    parser.add_argument('--serve', type=str, default=config.get('serve_address', ''), help="Also serve predicts on 'tcp://host:port' or 'unix:///path'")
+    args = parser.parse_args()
+    serving_settings = serving.apply_serving_config(args.threads, args.interop_threads, args.cpus, args.worker)
+
+    root_path = 'models/polyfish'
+    prefix = ''
+    net = model.load_inference(root_path + '-latest', config)
+    model.warmup(net, config)
+    training = False
+    train_thread = None
+    predictor = PredictorBatcher(net, config.get('feature_cache_size', FEATURE_CACHE_SIZE), config.get('max_queue', MAX_QUEUE), args.compile)
 
-while True:
-    line = sys.stdin.readline()
-    if not line:
-        break
+    server_thread = InferenceServer(predictor).start(args.serve) if args.serve else None
 
-    try:
-        data = json.loads(line)
-    except:
-        model.logger.exception("Invalid JSON: %s", line)
-        continue
+    if config.get('metrics_interval', 0) > 0:
+        metrics.start_flush(config.get('metrics_file', 'metrics.jsonl'), config['metrics_interval'])
 
-    cmd = data['cmd']
+    # Readiness goes to stderr, stdout only carries replies
+    sys.stderr.write(json.dumps({
+        "status": 'ready',
+        "startup_ms": round((time.perf_counter() - startup_start) * 1000),
+        **serving_settings,
+        **({ "compile": predictor.compile_report } if predictor.compile_report else {}),
+    }) + '\n')
+    sys.stderr.flush()
 
-    if cmd == 'train':
-        filepath = root_path +  data.get('prefix', prefix)
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            # Without a parent process keep serving socket clients
+            if server_thread is not None:
+                server_thread.join()
+            break
 
-        if training:
-            reply({ "status": 'busy' })
+        try:
+            data = json.loads(line)
+        except:
+            model.logger.exception("Invalid JSON: %s", line)
+            reply({ "status": 'error', "message": 'Invalid JSON' })
             continue
 
-        training = True
-
-        def _train_wrapper():
-            global training, net
-            try:
-                model.self_train(
-                    net,
-                    data.get('iterations', 1000),
-                    data.get('n_games', 3),
-                    data.get('epochs', 100),
-                    data.get('n_sims', 1000),
-                    data.get('temperature', 0.7),
-                    data.get('cPuct', 1.0),
-                    data.get('gamma', 0.997),
-                    data.get('deterministic', False),
-                    data.get('batch_size', 16),
-                    data.get('dirichlet', True),
-                    data.get('rollouts', 50),
-                    filepath,
-                    data.get('settings', {}),
-                )
-            except Exception as e:
-                model.logger.exception("Training thread crashed")
-            finally:
-                training = False
-
-        train_thread = threading.Thread(target=_train_wrapper, daemon=True)
-        train_thread.start()
-
-        reply({ "status": 'success' })
-
-    elif cmd == 'predict':
-        output = predictor.predict(obs_to_tensor(data))
-        reply({
-            'pi_action': output[0],
-            'pi_actor': output[1],
-            'pi_target': output[2],
-            'pi_struct': output[3],
-            'pi_skill': output[4],
-            'pi_unit': output[5],
-            'pi_tech': output[6],
-            'pi_reward': output[7],
-            'v_win': output[8],
-            'v_eco': output[9],
-            'v_mil': output[10],
-        })
+        cmd = None
+        try:
+            cmd = data['cmd']
+
+            if cmd == 'train':
+                filepath = root_path +  data.get('prefix', prefix)
+
+                if training:
+                    reply({ "status": 'busy' })
+                    continue
+
+                training = True
+
+                def _train_wrapper():
+                    nonlocal training
+                    try:
+                        model.self_train(net, filename=filepath, config=config, **model.train_options(data))
+                    except Exception as e:
+                        model.logger.exception("Training thread crashed")
+                    finally:
+                        training = False
+
+                train_thread = threading.Thread(target=_train_wrapper, daemon=True)
+                train_thread.start()
+
+                reply({ "status": 'success' })
+
+            elif cmd == 'predict' or cmd == 'predict_batch':
+                # Optional head mask, e.g. ['v_win'] for a value-only evaluation.
+                # With 'moves' (legal moves, packed or dicts) a result carries one prior per move.
+                # predict_batch takes 'observations': [{ 'map', 'player', 'moves'? }, ...] and replies
+                # with a list of results in the same order, heads applying to all of them.
+                # 'priority': 'high' | 'normal' and 'timeout_ms' schedule it against other clients.
+                observations, heads, moves, priority, timeout = parse_predict(data)
+                results = predictor.predict_batch([obs_to_tensor(obs) for obs in observations], heads, moves, priority, timeout)
+                reply(results if cmd == 'predict_batch' else results[0])
+
+            elif cmd == 'stats':
+                reply(metrics.snapshot())
+
+            elif cmd == 'profile':
+                predictor.profile(data.get('batches', 50), data.get('filename', 'predict_trace.json'))
+                reply({ "status": 'success' })
+
+            else:
+                raise ValueError(f"Unknown command: {cmd}")
+
+        except Exception as e:
+            # Bad commands, full queues and failed batches alike, the parent is waiting on a reply
+            model.logger.exception("Command %s failed", cmd)
+            reply({ "status": 'error', "message": str(e) })
+
+if __name__ == '__main__':
+    main()
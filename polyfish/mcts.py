@@ -0,0 +1,217 @@
+import math
+import numpy as np
+import torch
+from action import encode_valid_moves, score_moves, move_priors, net_output_to_predictions, policy_targets
+from gameTypes import MOVE_NAMES, unpack_move
+from game import GameInterface
+from obs import encode_sparse
+from trajectories import record_to_dataset
+
+# Dirichlet noise mixed into the root priors when enabled
+DIRICHLET_ALPHA = 0.3
+DIRICHLET_EPSILON = 0.25
+
+class NetEvaluator:
+    """Evaluates a batch of leaves with one PolytopiaNet forward pass."""
+    def __init__(self, net, max_size: int, device: torch.device | None = None):
+        self.net = net
+        self.max_size = max_size
+        self.device = device or next(net.parameters()).device
+
+    def __call__(self, observations: list[dict], legal_moves: list[list[int]]):
+        """
+        Returns:
+            (priors, values), priors[i] holding one prior per legal_moves[i] and values[i]
+            the v_win of observations[i] for its player.
+        """
+        batch = {
+            'map': torch.from_numpy(np.stack([obs['map'] for obs in observations])).to(self.device).float(),
+            'player': torch.from_numpy(np.stack([obs['player'] for obs in observations])).to(self.device).float(),
+        }
+        with torch.no_grad():
+            output = self.net(batch)
+            move_indices = encode_valid_moves(legal_moves, self.max_size, self.device)
+            priors = move_priors(score_moves(net_output_to_predictions(output), move_indices)).cpu().numpy()
+            values = output['v_win'][:, 0].cpu().numpy()
+        return [priors[i, :len(moves)] for i, moves in enumerate(legal_moves)], values.tolist()
+
+class Node:
+    __slots__ = ('state', 'player', 'moves', 'priors', 'visits', 'values', 'children', 'pending')
+
+    def __init__(self, state, player: int):
+        self.state = state
+        self.player = player
+        self.moves = None     # packed legal moves, None until expanded
+        self.priors = None    # [M]
+        self.visits = None    # [M] edge visit counts, virtual loss included
+        self.values = None    # [M] edge value sums, from this node's player perspective
+        self.children = None  # [M] Node | None
+        self.pending = False  # queued for evaluation in the current batch
+
+    def expand(self, moves: list[int], priors: np.ndarray):
+        self.moves = moves
+        self.priors = np.asarray(priors, dtype=np.float64)
+        self.visits = np.zeros(len(moves), dtype=np.float64)
+        self.values = np.zeros(len(moves), dtype=np.float64)
+        self.children = [None] * len(moves)
+
+class MCTS:
+    """
+    Batched PUCT search over a GameInterface.
+    Each round descends up to batch_size times, using virtual loss to spread the descents
+    over different leaves, then evaluates all collected leaves in a single evaluator call.
+    """
+    def __init__(
+        self,
+        game: GameInterface,
+        evaluator,
+        n_sims: int = 1000,
+        cPuct: float = 1.0,
+        temperature: float = 0.7,
+        dirichlet: bool = True,
+        batch_size: int = 32,
+        virtual_loss: float = 1.0,
+        rng: np.random.Generator | None = None,
+    ):
+        self.game = game
+        self.evaluator = evaluator
+        self.n_sims = n_sims
+        self.cPuct = cPuct
+        self.temperature = temperature
+        self.dirichlet = dirichlet
+        self.batch_size = batch_size
+        self.virtual_loss = virtual_loss
+        self.rng = rng or np.random.default_rng()
+
+    def search(self, state) -> tuple[list[int], np.ndarray, float]:
+        """
+        Returns:
+            (moves, visit probabilities at self.temperature, root value)
+        """
+        root = Node(state, self.game.current_player(state))
+        root_value = self._evaluate([root])[0]
+        if not root.moves:
+            return [], np.zeros(0), root_value
+
+        if self.dirichlet:
+            noise = self.rng.dirichlet([DIRICHLET_ALPHA] * len(root.moves))
+            root.priors = (1 - DIRICHLET_EPSILON) * root.priors + DIRICHLET_EPSILON * noise
+
+        sims = 0
+        while sims < self.n_sims:
+            leaves = []
+            for _ in range(min(self.batch_size, self.n_sims - sims)):
+                path, leaf = self._select(root)
+                if self.game.is_terminal(leaf.state):
+                    self._apply_virtual_loss(path, -self.virtual_loss)
+                    self._backup(path, self.game.terminal_value(leaf.state), leaf.player)
+                    sims += 1
+                elif leaf.pending:
+                    # Collided with a leaf already queued, evaluate what we have
+                    self._apply_virtual_loss(path, -self.virtual_loss)
+                    break
+                else:
+                    leaf.pending = True
+                    leaves.append((path, leaf))
+                    sims += 1
+
+            if leaves:
+                values = self._evaluate([leaf for _, leaf in leaves])
+                for (path, leaf), value in zip(leaves, values):
+                    leaf.pending = False
+                    self._apply_virtual_loss(path, -self.virtual_loss)
+                    self._backup(path, value, leaf.player)
+
+        return root.moves, self._visit_probs(root.visits), root_value
+
+    def select_move(self, state) -> tuple[int | None, list[int], np.ndarray]:
+        """Runs a search and samples a move from the visit distribution."""
+        moves, probs, _ = self.search(state)
+        if not moves:
+            return None, moves, probs
+        return moves[self.rng.choice(len(moves), p=probs)], moves, probs
+
+    def _select(self, root: Node) -> tuple[list[tuple[Node, int]], Node]:
+        path = []
+        node = root
+        while node.moves:
+            total = node.visits.sum()
+            q = np.divide(node.values, node.visits, out=np.zeros_like(node.values), where=node.visits > 0)
+            u = self.cPuct * node.priors * math.sqrt(total + 1) / (1 + node.visits)
+            index = int(np.argmax(q + u))
+            child = node.children[index]
+            if child is None:
+                child_state = self.game.step(node.state, node.moves[index])
+                child = node.children[index] = Node(child_state, self.game.current_player(child_state))
+            path.append((node, index))
+            node = child
+        self._apply_virtual_loss(path, self.virtual_loss)
+        return path, node
+
+    def _evaluate(self, leaves: list[Node]) -> list[float]:
+        legal_moves = [self.game.legal_moves(leaf.state) for leaf in leaves]
+        priors, values = self.evaluator([self.game.observe(leaf.state) for leaf in leaves], legal_moves)
+        for leaf, moves, leaf_priors in zip(leaves, legal_moves, priors):
+            if moves and leaf_priors.sum() <= 0:
+                leaf_priors = np.full(len(moves), 1 / len(moves))
+            leaf.expand(moves, leaf_priors)
+        return values
+
+    @staticmethod
+    def _apply_virtual_loss(path: list[tuple[Node, int]], amount: float):
+        for node, index in path:
+            node.visits[index] += amount
+            node.values[index] -= amount
+
+    @staticmethod
+    def _backup(path: list[tuple[Node, int]], value: float, player: int):
+        for node, index in path:
+            node.visits[index] += 1
+            node.values[index] += value if node.player == player else -value
+
+    def _visit_probs(self, visits: np.ndarray) -> np.ndarray:
+        if self.temperature <= 1e-9 or visits.sum() <= 0:
+            probs = np.zeros_like(visits)
+            probs[int(np.argmax(visits))] = 1.0
+            return probs
+        visits = visits ** (1 / self.temperature)
+        return visits / visits.sum()
+
+def play_game_record(mcts: MCTS, config: dict, seed: int | None = None, max_moves: int = 2000) -> dict:
+    """
+    Plays one game of mcts against itself.
+    Returns:
+        The game record (see trajectories.GameRecord): samples (obs, policy targets, move type),
+        the player and immediate reward of each sample, and the final outcome per player.
+    """
+    game = mcts.game
+    state = game.initial_state(seed)
+    samples, players, rewards = [], [], []
+    while not game.is_terminal(state) and len(samples) < max_moves:
+        move, moves, probs = mcts.select_move(state)
+        if move is None:
+            break
+        obs = game.observe(state)
+        samples.append((
+            { 'map': encode_sparse(obs['map']), 'player': obs['player'].tolist() },
+            policy_targets(moves, probs.tolist(), config),
+            MOVE_NAMES[unpack_move(move)[0]],
+        ))
+        players.append(game.current_player(state))
+        next_state = game.step(state, move)
+        rewards.append(game.reward(state, move, next_state))
+        state = next_state
+
+    outcome = game.terminal_value(state) if game.is_terminal(state) else 0.0
+    last_player = game.current_player(state)
+    outcomes = {player: outcome if player == last_player else -outcome for player in set(players) | {last_player}}
+    return { 'seed': seed, 'samples': samples, 'players': players, 'rewards': rewards, 'outcomes': outcomes }
+
+def self_play_game(mcts: MCTS, config: dict, gamma: float = 0.997, seed: int | None = None, max_moves: int = 2000):
+    """
+    Plays one game of mcts against itself.
+    Returns:
+        Dataset samples (obs, policy targets, value targets, move type), v_win being the
+        player's later rewards plus final outcome, discounted by gamma per remaining move.
+    """
+    return record_to_dataset(play_game_record(mcts, config, seed, max_moves), gamma)
@@ -0,0 +1,139 @@
+import json
+import time
+import threading
+import torch
+from collections import deque
+from contextlib import contextmanager
+
+# Recent samples kept per histogram for percentiles
+HISTOGRAM_WINDOW = 1024
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.recent = deque(maxlen=HISTOGRAM_WINDOW)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def summary(self) -> dict:
+        if not self.count:
+            return { 'count': 0 }
+        recent = sorted(self.recent)
+        return {
+            'count': self.count,
+            'mean': self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'p50': recent[len(recent) // 2],
+            'p95': recent[min(len(recent) - 1, int(len(recent) * 0.95))],
+        }
+
+class Metrics:
+    """
+    Thread safe counters and histograms, served cumulative by the stats command and
+    flushed as JSONL per interval.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        # Since the last flush, min/max/percentiles can't be recovered from the cumulative ones
+        self.interval_histograms = {}
+        self.flushed_counters = {}
+        self.flush_thread = None
+
+    def inc(self, name: str, amount: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            for histograms in (self.histograms, self.interval_histograms):
+                if name not in histograms:
+                    histograms[name] = Histogram()
+                histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Observes the duration of the block in milliseconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000)
+
+    @staticmethod
+    def _snapshot(counters: dict, histograms: dict) -> dict:
+        data = {
+            'time': time.time(),
+            'counters': counters,
+            'histograms': {name: h.summary() for name, h in histograms.items()},
+        }
+        hits, misses = counters.get('cache_hits', 0), counters.get('cache_misses', 0)
+        if hits + misses:
+            data['counters']['cache_hit_rate'] = hits / (hits + misses)
+        return data
+
+    def snapshot(self) -> dict:
+        """Everything since startup."""
+        with self.lock:
+            return self._snapshot(dict(self.counters), self.histograms)
+
+    def interval_snapshot(self) -> dict:
+        """Everything since the previous call, the live counters are left alone."""
+        with self.lock:
+            counters = {
+                name: value - self.flushed_counters.get(name, 0)
+                for name, value in self.counters.items()
+            }
+            data = self._snapshot(counters, self.interval_histograms)
+            self.flushed_counters = dict(self.counters)
+            self.interval_histograms = {}
+        return data
+
+    def start_flush(self, filename: str, interval: float):
+        """Appends a snapshot of the last interval to filename every interval seconds."""
+        if self.flush_thread is not None:
+            return
+
+        def _flush():
+            while True:
+                time.sleep(interval)
+                with open(filename, 'a') as f:
+                    f.write(json.dumps(self.interval_snapshot()) + '\n')
+
+        self.flush_thread = threading.Thread(target=_flush, daemon=True)
+        self.flush_thread.start()
+
+class ProfilerWindow:
+    """Captures a torch.profiler trace over the next n_steps calls to step()."""
+    def __init__(self, n_steps: int, filename: str):
+        self.remaining = n_steps
+        self.filename = filename
+        self.profiler = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU] + (
+                [torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else []
+            ),
+            record_shapes=True,
+        )
+        self.profiler.start()
+
+    def step(self) -> bool:
+        """Returns True once the window closed and the trace was exported."""
+        self.profiler.step()
+        self.remaining -= 1
+        if self.remaining > 0:
+            return False
+        self.profiler.stop()
+        self.profiler.export_chrome_trace(self.filename)
+        return True
+
+metrics = Metrics()
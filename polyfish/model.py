@@ -1,54 +1,74 @@
 import numpy as np
+import os
 from os import path
 from net import PolytopiaNet # Assuming your PolytopiaNet class is in net.py
-from requests import post
+from metrics import metrics
+from weights import save_flat, load_flat
+from obs import collate_maps
 from random import shuffle
-import torch, logging
+import torch, logging, time, math
 import torch.nn as nn # Added for type hinting and nn.functional
 import torch.nn.functional as F
 
 # Updated Dataset Type Hint
-ObsDict = dict # e.g., {'map': np.ndarray, 'player': np.ndarray}
+ObsDict = dict # e.g., {'map': np.ndarray | sparse dict (see obs.py), 'player': np.ndarray}
 TargetPoliciesDict = dict # e.g., {'pi_action': np.ndarray, 'pi_option_struct': np.ndarray, ...}
 TargetValuesDict = dict   # e.g., {'v_win': float, 'v_econ': float, ...}
 MoveTypeStr = str
+# Samples may carry a trailing float weight (see trajectories.dedup_dataset), 1.0 when absent
 Dataset = list[tuple[ObsDict, TargetPoliciesDict, TargetValuesDict, MoveTypeStr]]
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%H:%M:%S',
-    filename='training.log',
-    filemode='a' # Append to log file
-)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%H:%M:%S'))
 logger = logging.getLogger()
-if not logger.handlers:
-    logger.addHandler(console_handler)
-logger.setLevel(logging.INFO)
+logging_ready = False
+
+def setup_logging():
+    """
+    Logs INFO and up to training.log and the console, once. Not at import: the predictor
+    only loads a net, warnings and errors before this reach stderr all the same.
+    """
+    global logging_ready
+    if logging_ready:
+        return
+    logging_ready = True
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%H:%M:%S',
+        filename='training.log',
+        filemode='a' # Append to log file
+    )
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%H:%M:%S'))
+    if not logger.handlers:
+        logger.addHandler(console_handler)
+    logger.setLevel(logging.INFO)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+def build(config: dict, n_res_blocks: int = 12, target_device: torch.device = device) -> PolytopiaNet:
+    # Parameters are created directly on target_device, 'meta' skips allocation and init entirely
+    with torch.device(target_device):
+        return PolytopiaNet(
+            dim_map_channels=config['dim_map_channels'],
+            dim_map_size=config['dim_map_size'],
+            dim_player=config['dim_player'],
+            dim_struct=config['dim_struct'],
+            dim_skill=config['dim_ability'],
+            dim_unit=config['dim_unit'],
+            num_action_types=config['dim_moves'],
+            dim_tech=config['dim_tech'],
+            num_res_blocks=n_res_blocks,
+            num_hidden_channels=config.get('hidden_channels', 128),
+            num_player_hidden=config.get('num_player_hidden', 32)
+        )
+
 def load(filename: str, config: dict, n_res_blocks: int = 12) -> PolytopiaNet:
     if not filename.endswith('.zip'):
         filename += '.zip'
-    net = PolytopiaNet(
-        dim_map_channels=config['dim_map_channels'],
-        dim_map_size=config['dim_map_size'],
-        dim_player=config['dim_player'],
-        dim_struct=config['dim_struct'],
-        dim_skill=config['dim_ability'],
-        dim_unit=config['dim_unit'],
-        num_action_types=config['dim_moves'],
-        dim_tech=config['dim_tech'],
-        num_res_blocks=n_res_blocks,
-        num_hidden_channels=config.get('hidden_channels', 128),
-        num_player_hidden=config.get('num_player_hidden', 32)
-    ).to(device)
+    net = build(config, n_res_blocks)
     if path.exists(filename):
         try:
-            net.load_state_dict(torch.load(filename, map_location=device))
+            net.load_state_dict(torch.load(filename, map_location=device, mmap=True))
             logger.info(f"Successfully loaded model from {filename}")
         except Exception as e:
             logger.error(f"Error loading model from {filename}: {e}. Starting with a new model.")
@@ -57,6 +77,74 @@ def load(filename: str, config: dict, n_res_blocks: int = 12) -> PolytopiaNet:
     net.eval()
     return net
 
+def checkpoint_stamp(filename: str) -> list | None:
+    """(mtime_ns, size) of filename's .zip checkpoint, None without one."""
+    try:
+        stat = os.stat(filename + '.zip')
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+def export_inference(net: PolytopiaNet, filename: str):
+    """
+    Saves the flat, mmap-able weights of net next to its checkpoint (see weights.py),
+    stamped with the checkpoint they were exported from. Call after saving the checkpoint.
+    """
+    save_flat(net.state_dict(), filename + '.weights', {
+        'n_res_blocks': len(net.res_blocks),
+        'checkpoint': checkpoint_stamp(filename),
+    })
+    # The torch.save artifact the flat file replaced: torch.load(mmap=True) still copies the
+    # tensors into each process' net, so nothing reads it any more
+    legacy = filename + '.inference.pt'
+    if path.exists(legacy):
+        os.remove(legacy)
+        logger.info(f"Removed superseded inference artifact {legacy}")
+
+def load_inference(filename: str, config: dict, n_res_blocks: int = 12) -> PolytopiaNet:
+    """
+    Loads the flat weights of filename, falling back to the .zip checkpoint (and re-exporting
+    them) when they are missing or were not exported from the current checkpoint.
+    On CPU the parameters stay backed by the copy-on-write file map, so every predictor
+    process serving the same file shares one copy of the weights.
+    """
+    artifact = filename + '.weights'
+    stamp = checkpoint_stamp(filename)
+    state_dict, metadata = None, {}
+    if path.exists(artifact):
+        try:
+            state_dict, metadata = load_flat(artifact)
+        except Exception as e:
+            logger.error(f"Error reading inference weights {artifact}: {e}. Falling back to checkpoint.")
+    if state_dict is not None and stamp is not None and metadata.get('checkpoint') != stamp:
+        # e.g. a copied checkpoint, or a crash between saving it and exporting
+        logger.warning(f"Inference weights {artifact} were not exported from {filename}.zip, re-exporting.")
+        state_dict = None
+    if state_dict is None:
+        net = load(filename, config, n_res_blocks)
+        if stamp is not None:
+            export_inference(net, filename)
+        return net
+    try:
+        net = build(config, metadata.get('n_res_blocks', n_res_blocks), torch.device('meta'))
+        net.load_state_dict(state_dict, assign=True)
+        net.to(device)
+        logger.info(f"Successfully loaded inference weights {artifact}")
+    except Exception as e:
+        logger.error(f"Error loading inference weights {artifact}: {e}. Falling back to checkpoint.")
+        return load(filename, config, n_res_blocks)
+    net.eval()
+    return net
+
+def warmup(net: PolytopiaNet, config: dict, batch_sizes: tuple = (1, 8, 16, 32, 64)):
+    """Runs a forward pass per batch size so the first real predicts don't pay for allocator and kernel setup."""
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            net({
+                'map': torch.zeros((batch_size, config['dim_map_channels'], config['dim_map_size'], config['dim_map_size']), device=device),
+                'player': torch.zeros((batch_size, config['dim_player']), device=device),
+            })
+
 def train_network(
     net: PolytopiaNet,
     dataset: Dataset,
@@ -65,10 +153,30 @@ def train_network(
     learning_rate: float = 0.001,
     policy_loss_weights: dict = None,
     value_loss_weights: dict = None,
-    gradient_clipping_norm: float = None
+    gradient_clipping_norm: float = None,
+    # Memory for compute: sum gradients over micro-batches of batch_size up to effective_batch_size
+    # samples per optimizer step, and/or recompute the residual activations in backward
+    effective_batch_size: int | None = None,
+    lr_scaling: str = 'sqrt',
+    checkpointing: bool = False
 ):
-    optimizer = torch.optim.Adam(net.parameters(), lr=learning_rate)
+    import distributed
+    from trajectories import sample_weight
+    setup_logging()
+    accumulation_steps = max(1, -(-(effective_batch_size or batch_size) // batch_size))
+    # The learning rate is given for batch_size, scale it to the effective batch. Linear scaling
+    # is the SGD rule, with Adam it overshoots at large factors (64x for 1024 over 16)
+    lr_scale = { 'linear': accumulation_steps, 'sqrt': math.sqrt(accumulation_steps), 'none': 1.0 }[lr_scaling]
+    optimizer = torch.optim.Adam(net.parameters(), lr=learning_rate * lr_scale)
     net.train()
+    if accumulation_steps > 1 or checkpointing:
+        logger.info(f"Accumulation Steps: {accumulation_steps} (effective batch {accumulation_steps * batch_size}, lr {learning_rate * lr_scale:g}), Checkpointing: {checkpointing}")
+
+    if distributed.is_distributed():
+        # Every rank starts from rank 0's weights and trains on its own share of the samples
+        distributed.broadcast_state(net)
+        dataset = distributed.shard(dataset)
+        logger.info(f"Rank {distributed.rank()}/{distributed.world_size()}: {len(dataset)} samples")
 
     epoch_losses = { 'total': [] }
     try:
@@ -93,138 +201,166 @@ def train_network(
     if value_loss_weights is None: value_loss_weights = {}
     default_policy_weight = 1.0
 
-    for epoch_idx in range(epochs):
-        shuffle(dataset)
-        logger.info(f"Epoch {epoch_idx+1}/{epochs}")
-        batch_num = 0
-        for i in range(0, len(dataset), batch_size):
-            batch_num += 1
-            current_batch = dataset[i : i + batch_size]
-            if not current_batch: continue
-
-            map_batch = [sample[0]['map'] for sample in current_batch]
-            player_batch = [sample[0]['player'] for sample in current_batch]
-            batched_obs = {
-                'map': torch.tensor(np.array(map_batch), dtype=torch.float32).to(device),
-                'player': torch.tensor(np.array(player_batch), dtype=torch.float32).to(device)
-            }
-            actual_batch_size = batched_obs['map'].size(0)
-
-            target_policies_list = [sample[1] for sample in current_batch]
-            target_values_list = [sample[2] for sample in current_batch]
-            # move_types_list = [sample[3] for sample in current_batch]
-
-            optimizer.zero_grad()
-            predictions = net(batched_obs) # dict of tensors
-            batch_total_loss = torch.tensor(0.0).to(device)
-            current_batch_losses_log = {key: [] for key in epoch_losses if key != 'total'}
-
-            # Policy Losses
-            for sample_idx in range(actual_batch_size):
-                sample_target_policies = target_policies_list[sample_idx]
-
-                for net_output_key, batch_pred_logits in predictions.items(): # net_output_key has pi_
-                    if not net_output_key.startswith('pi_'): continue
-                    if net_output_key not in sample_target_policies:continue
-
-                    sample_pred_logits = batch_pred_logits[sample_idx]
-                    sample_target_p_numpy = sample_target_policies[net_output_key]
+    net.checkpointing = checkpointing
+    try:
+        for epoch_idx in range(epochs):
+            shuffle(dataset)
+            logger.info(f"Epoch {epoch_idx+1}/{epochs}")
+            epoch_start = time.perf_counter()
+            batch_num = 0
+            for i in range(0, len(dataset), batch_size):
+                batch_num += 1
+                current_batch = dataset[i : i + batch_size]
+                if not current_batch: continue
+
+                # First micro-batch of an optimizer step: reset the gradients and weigh every
+                # micro-batch loss by the step's total sample weight
+                micro_step = (batch_num - 1) % accumulation_steps
+                if micro_step == 0:
+                    optimizer.zero_grad()
+                    step_weight = sum(sample_weight(sample) for sample in dataset[i : i + batch_size * accumulation_steps])
+                last_micro_step = micro_step == accumulation_steps - 1 or i + batch_size >= len(dataset)
+
+                map_batch = [sample[0]['map'] for sample in current_batch]
+                player_batch = [sample[0]['player'] for sample in current_batch]
+                batched_obs = {
+                    'map': collate_maps(map_batch, device),
+                    'player': torch.tensor(np.array(player_batch), dtype=torch.float32).to(device)
+                }
+                actual_batch_size = batched_obs['map'].size(0)
+
+                target_policies_list = [sample[1] for sample in current_batch]
+                target_values_list = [sample[2] for sample in current_batch]
+                sample_weights = [sample_weight(sample) for sample in current_batch]
+                # move_types_list = [sample[3] for sample in current_batch]
+
+                predictions = net(batched_obs) # dict of tensors
+                batch_total_loss = torch.tensor(0.0).to(device)
+                # This micro-batch's share of the step loss, as summed over one batch of the whole step
+                step_loss = torch.tensor(0.0).to(device)
+                current_batch_losses_log = {key: [] for key in epoch_losses if key != 'total'}
+
+                # Policy Losses
+                for sample_idx in range(actual_batch_size):
+                    sample_target_policies = target_policies_list[sample_idx]
+
+                    for net_output_key, batch_pred_logits in predictions.items(): # net_output_key has pi_
+                        if not net_output_key.startswith('pi_'): continue
+                        if net_output_key not in sample_target_policies:continue
+
+                        sample_pred_logits = batch_pred_logits[sample_idx]
+                        sample_target_p_numpy = sample_target_policies[net_output_key]
                     
-                    if sample_target_p_numpy is None: continue
+                        if sample_target_p_numpy is None: continue
 
-                    sample_target_p = torch.tensor(sample_target_p_numpy, dtype=torch.float32).to(device)
+                        sample_target_p = torch.tensor(sample_target_p_numpy, dtype=torch.float32).to(device)
                     
-                    # Use net_output_key (with _logits) for weight lookup
-                    weight = policy_loss_weights.get(net_output_key, default_policy_weight)
-                    loss_val_sample = torch.tensor(0.0).to(device)
-
-                    if net_output_key == 'pi_reward':
-                        # sample_pred_logits is scalar, sample_target_p should be scalar (0.0 or 1.0)
-                        loss_fn = nn.BCEWithLogitsLoss()
-                        loss_val_sample = loss_fn(sample_pred_logits.unsqueeze(0), sample_target_p.unsqueeze(0)) * weight
-                    else: # Categorical policy heads
-                        # Ensure logits and targets are 1D for per-sample calculation
-                        if sample_pred_logits.dim() == 0: sample_pred_logits = sample_pred_logits.unsqueeze(0)
-                        if sample_target_p.dim() == 0: sample_target_p = sample_target_p.unsqueeze(0)
+                        # Use net_output_key (with _logits) for weight lookup
+                        weight = policy_loss_weights.get(net_output_key, default_policy_weight) * sample_weights[sample_idx]
+                        loss_val_sample = torch.tensor(0.0).to(device)
+
+                        if net_output_key == 'pi_reward':
+                            # sample_pred_logits is scalar, sample_target_p should be scalar (0.0 or 1.0)
+                            loss_fn = nn.BCEWithLogitsLoss()
+                            loss_val_sample = loss_fn(sample_pred_logits.unsqueeze(0), sample_target_p.unsqueeze(0)) * weight
+                        else: # Categorical policy heads
+                            # Ensure logits and targets are 1D for per-sample calculation
+                            if sample_pred_logits.dim() == 0: sample_pred_logits = sample_pred_logits.unsqueeze(0)
+                            if sample_target_p.dim() == 0: sample_target_p = sample_target_p.unsqueeze(0)
                         
-                        # Handle empty target (e.g., no valid options for this choice)
-                        if sample_target_p.numel() == 0 or \
-                           (sample_target_p.numel() > 0 and sample_target_p.sum().item() == 0.0):
-                            loss_val_sample = torch.tensor(0.0).to(device) # No loss if target is empty or all zeros
-                        elif sample_target_p.shape[0] != sample_pred_logits.shape[0]:
-                            # logger.warning(f"Shape mismatch for {net_output_key} in sample {sample_idx}. Pred: {sample_pred_logits.shape}, Target: {sample_target_p.shape}. Skipping.")
-                            continue
-                        else:
-                            log_probs_sample = F.log_softmax(sample_pred_logits, dim=-1)
-                            loss_val_sample = -torch.sum(sample_target_p * log_probs_sample) * weight
+                            # Handle empty target (e.g., no valid options for this choice)
+                            if sample_target_p.numel() == 0 or \
+                               (sample_target_p.numel() > 0 and sample_target_p.sum().item() == 0.0):
+                                loss_val_sample = torch.tensor(0.0).to(device) # No loss if target is empty or all zeros
+                            elif sample_target_p.shape[0] != sample_pred_logits.shape[0]:
+                                # logger.warning(f"Shape mismatch for {net_output_key} in sample {sample_idx}. Pred: {sample_pred_logits.shape}, Target: {sample_target_p.shape}. Skipping.")
+                                continue
+                            else:
+                                log_probs_sample = F.log_softmax(sample_pred_logits, dim=-1)
+                                loss_val_sample = -torch.sum(sample_target_p * log_probs_sample) * weight
                     
-                    if not torch.isnan(loss_val_sample) and not torch.isinf(loss_val_sample):
-                        batch_total_loss += loss_val_sample # Add this sample's head loss to batch total
-                        if net_output_key in current_batch_losses_log: # Log with no_suffix key
-                             current_batch_losses_log[net_output_key].append(loss_val_sample.item())
-
-            # Value Losses
-            for net_output_key, batch_pred_v in predictions.items(): # net_output_key is e.g. 'v_win'
-                if not net_output_key.startswith('v_'):
-                    continue
-
-                valid_target_v_list, valid_pred_v_indices = [], []
-                for sample_idx in range(actual_batch_size):
-                    sample_target_val = target_values_list[sample_idx].get(net_output_key)
-                    if sample_target_val is not None:
-                        valid_target_v_list.append(sample_target_val)
-                        valid_pred_v_indices.append(sample_idx)
+                        if not torch.isnan(loss_val_sample) and not torch.isinf(loss_val_sample):
+                            batch_total_loss += loss_val_sample # Add this sample's head loss to batch total
+                            step_loss += loss_val_sample
+                            if net_output_key in current_batch_losses_log: # Log with no_suffix key
+                                 current_batch_losses_log[net_output_key].append(loss_val_sample.item())
+
+                # Value Losses
+                for net_output_key, batch_pred_v in predictions.items(): # net_output_key is e.g. 'v_win'
+                    if not net_output_key.startswith('v_'):
+                        continue
+
+                    valid_target_v_list, valid_pred_v_indices, valid_weights = [], [], []
+                    for sample_idx in range(actual_batch_size):
+                        sample_target_val = target_values_list[sample_idx].get(net_output_key)
+                        if sample_target_val is not None:
+                            valid_target_v_list.append(sample_target_val)
+                            valid_pred_v_indices.append(sample_idx)
+                            valid_weights.append(sample_weights[sample_idx])
                 
-                if not valid_target_v_list: continue
+                    if not valid_target_v_list: continue
 
-                target_v_tensor = torch.tensor(np.array(valid_target_v_list), dtype=torch.float32).to(device).unsqueeze(1)
-                pred_v_tensor_for_loss = batch_pred_v[valid_pred_v_indices] # Select predictions for which targets exist
+                    target_v_tensor = torch.tensor(np.array(valid_target_v_list), dtype=torch.float32).to(device).unsqueeze(1)
+                    pred_v_tensor_for_loss = batch_pred_v[valid_pred_v_indices] # Select predictions for which targets exist
 
-                weight = value_loss_weights.get(net_output_key, 1.0) # Use direct key for weight
-                loss_val_batch_head = F.mse_loss(pred_v_tensor_for_loss, target_v_tensor) * weight
+                    weight = value_loss_weights.get(net_output_key, 1.0) # Use direct key for weight
+                    weights_v_tensor = torch.tensor(valid_weights, dtype=torch.float32, device=device).unsqueeze(1)
+                    # Weighted mean, equal to the plain MSE when every weight is 1
+                    loss_val_batch_head = (weights_v_tensor * (pred_v_tensor_for_loss - target_v_tensor) ** 2).sum() / weights_v_tensor.sum() * weight
                 
-                if not torch.isnan(loss_val_batch_head) and not torch.isinf(loss_val_batch_head):
-                    batch_total_loss += loss_val_batch_head # Add this head's total batch loss
-                    if net_output_key in current_batch_losses_log: # Log with direct key
-                         current_batch_losses_log[net_output_key].append(loss_val_batch_head.item())
-
-
-            if actual_batch_size > 0:
-                # Average the sum of all losses by the number of samples in the batch
-                final_batch_loss = batch_total_loss / actual_batch_size
-            else:
-                final_batch_loss = torch.tensor(0.0).to(device)
-
-            if final_batch_loss > 0 and final_batch_loss.requires_grad: # Ensure backward is called on a valid graph
-                final_batch_loss.backward()
-                if gradient_clipping_norm:
-                    torch.nn.utils.clip_grad_norm_(net.parameters(), gradient_clipping_norm)
-                optimizer.step()
-
-            # Log losses for this batch (average of items if multiple recorded)
-            if final_batch_loss.item() > 0 : # Only append if there was a loss
-                 epoch_losses['total'].append(final_batch_loss.item())
-            for key_log, loss_items_list in current_batch_losses_log.items():
-                if loss_items_list and key_log in epoch_losses:
-                    epoch_losses[key_log].append(np.mean(loss_items_list))
+                    if not torch.isnan(loss_val_batch_head) and not torch.isinf(loss_val_batch_head):
+                        batch_total_loss += loss_val_batch_head # Add this head's total batch loss
+                        # The head loss is a mean over this micro-batch, weigh it by its share of the step
+                        step_loss += loss_val_batch_head * weights_v_tensor.sum() / step_weight
+                        if net_output_key in current_batch_losses_log: # Log with direct key
+                             current_batch_losses_log[net_output_key].append(loss_val_batch_head.item())
+
+
+                if actual_batch_size > 0:
+                    # Average the sum of all losses by the (weighted) number of samples in the batch
+                    final_batch_loss = batch_total_loss / sum(sample_weights)
+                else:
+                    final_batch_loss = torch.tensor(0.0).to(device)
+
+                if final_batch_loss > 0 and step_loss.requires_grad: # Ensure backward is called on a valid graph
+                    (step_loss / step_weight).backward()
+                if last_micro_step:
+                    if distributed.is_distributed():
+                        distributed.all_reduce_gradients(net)
+                    if gradient_clipping_norm:
+                        torch.nn.utils.clip_grad_norm_(net.parameters(), gradient_clipping_norm)
+                    optimizer.step()
+                    net.weights_version += 1
+
+                # Log losses for this batch (average of items if multiple recorded)
+                if final_batch_loss.item() > 0 : # Only append if there was a loss
+                     epoch_losses['total'].append(final_batch_loss.item())
+                for key_log, loss_items_list in current_batch_losses_log.items():
+                    if loss_items_list and key_log in epoch_losses:
+                        epoch_losses[key_log].append(np.mean(loss_items_list))
             
-            if batch_num % 50 == 0 and actual_batch_size > 0 : # Print progress
-                logger.debug(f"  Batch {batch_num}/{len(dataset)//batch_size}, Avg Batch Loss: {final_batch_loss.item():.4f}")
-
-
-        # --- End of Epoch ---
-        avg_epoch_total_loss = np.mean(epoch_losses['total'][-(len(dataset)//batch_size):]) if epoch_losses['total'] else 0.0
-        logger.info(f"Epoch {epoch_idx+1} finished. Avg Total Loss: {avg_epoch_total_loss:.4f}")
-        for loss_name_key in epoch_losses.keys():
-            if loss_name_key != 'total':
-                losses_list_epoch = epoch_losses[loss_name_key]
-                # Only log if there were entries for this loss in the current epoch
-                current_epoch_loss_entries = losses_list_epoch[-(len(dataset)//batch_size):] if len(losses_list_epoch) >= (len(dataset)//batch_size) else losses_list_epoch
-                if current_epoch_loss_entries:
-                    avg_loss_head = np.mean(current_epoch_loss_entries)
-                    logger.info(f"  Avg {loss_name_key} Loss: {avg_loss_head:.4f}")
-        logger.info("-" * 30)
-
+                if batch_num % 50 == 0 and actual_batch_size > 0 : # Print progress
+                    logger.debug(f"  Batch {batch_num}/{len(dataset)//batch_size}, Avg Batch Loss: {final_batch_loss.item():.4f}")
+
+
+            # --- End of Epoch ---
+            avg_epoch_total_loss = np.mean(epoch_losses['total'][-(len(dataset)//batch_size):]) if epoch_losses['total'] else 0.0
+            epoch_time = time.perf_counter() - epoch_start
+            metrics.observe('train_samples_per_sec', len(dataset) * distributed.world_size() / max(epoch_time, 1e-9))
+            metrics.observe('train_loss_total', avg_epoch_total_loss)
+            logger.info(f"Epoch {epoch_idx+1} finished. Avg Total Loss: {avg_epoch_total_loss:.4f}")
+            for loss_name_key in epoch_losses.keys():
+                if loss_name_key != 'total':
+                    losses_list_epoch = epoch_losses[loss_name_key]
+                    # Only log if there were entries for this loss in the current epoch
+                    current_epoch_loss_entries = losses_list_epoch[-(len(dataset)//batch_size):] if len(losses_list_epoch) >= (len(dataset)//batch_size) else losses_list_epoch
+                    if current_epoch_loss_entries:
+                        avg_loss_head = np.mean(current_epoch_loss_entries)
+                        metrics.observe(f'train_loss_{loss_name_key}', avg_loss_head)
+                        logger.info(f"  Avg {loss_name_key} Loss: {avg_loss_head:.4f}")
+            logger.info("-" * 30)
+    finally:
+        net.checkpointing = False
 
     final_avg_losses_summary = {}
     for loss_name_key, all_losses_for_head in epoch_losses.items():
@@ -245,8 +381,26 @@ def self_train(
     learning_rate: float = 0.001,
     policy_loss_weights: dict = None,
     value_loss_weights: dict = None,
-    gradient_clipping_norm: float = None
+    gradient_clipping_norm: float = None,
+    # Local self-play, 0 workers uses the /selfplay server instead
+    config: dict | None = None,
+    workers: int = 0,
+    # Arena gating, 0 games promotes every iteration. Only with local self-play (workers > 0):
+    # the arena plays the same stand-in game, a net trained on the TS games is promoted ungated
+    gate_games: int = 0,
+    gate_threshold: float = 0.55,
+    # Directory to keep the local self-play games in, None keeps nothing
+    trajectory_dir: str | None = None,
+    # Merge duplicate positions into weighted samples before training
+    dedup: bool = True,
+    # See train_network
+    effective_batch_size: int | None = None,
+    lr_scaling: str = 'sqrt',
+    checkpointing: bool = False
 ):
+    import distributed
+    from trajectories import dedup_dataset
+    setup_logging()
     logger.info("Self-training started.")
     logger.info(f"Device: {device}")
     logger.info(f"Iterations: {iterations}, Games/Iter: {n_games}, Epochs/Iter: {epochs}, Sims/Move: {n_sims}")
@@ -255,6 +409,15 @@ def self_train(
     logger.info(f"Learning Rate: {learning_rate}, Grad Clip Norm: {gradient_clipping_norm}")
     logger.info(f"Policy Loss Weights: {policy_loss_weights}")
     logger.info(f"Value Loss Weights: {value_loss_weights}")
+    logger.info(f"Local Self-Play Workers: {workers}")
+    logger.info(f"Gate Games: {gate_games}, Gate Threshold: {gate_threshold}")
+    logger.info(f"Trajectory Dir: {trajectory_dir}, Dedup: {dedup}")
+    logger.info(f"Effective Batch Size: {effective_batch_size}, LR Scaling: {lr_scaling}, Checkpointing: {checkpointing}")
+
+    store = None
+    if trajectory_dir and workers > 0 and config and distributed.is_main():
+        from trajectories import TrajectoryStore
+        store = TrajectoryStore(trajectory_dir)
 
 
     for iteration_idx in range(iterations): # Renamed to iteration_idx
@@ -262,18 +425,35 @@ def self_train(
         try:
             # CRITICAL ASSUMPTION: request_self_play returns data in the new Dataset format:
             # list[tuple[ObsDict, TargetPoliciesDict, TargetValuesDict, MoveTypeStr]]
-            dataset: Dataset = request_self_play(
-                n_games, n_sims, temperature, cPuct, gamma, deterministic, dirichlet, rollouts, settings
-            )
+            # Distributed, rank 0 plays the games and hands the samples to every rank
+            if not distributed.is_main():
+                dataset = None
+            elif workers > 0 and config:
+                from selfplay import self_play_pool
+                dataset: Dataset = self_play_pool(
+                    net, config, n_games, workers, n_sims, temperature, cPuct, gamma, dirichlet,
+                    store=store
+                )
+            else:
+                dataset: Dataset = request_self_play(
+                    n_games, n_sims, temperature, cPuct, gamma, deterministic, dirichlet, rollouts, settings
+                )
+            dataset = distributed.broadcast_object(dataset)
             if not dataset:
                 logger.warning("Received empty dataset from self-play. Skipping training for this iteration.")
                 continue
 
             logger.info(f"Collected {len(dataset)} game states for training.")
+            if dedup:
+                n_samples = len(dataset)
+                dataset = dedup_dataset(dataset)
+                metrics.observe('train_dedup_ratio', len(dataset) / n_samples)
+                logger.info(f"Merged duplicate positions into {len(dataset)} weighted samples.")
 
             # Extract v_win for logging game outcomes, assuming 'v_win' is a key in TargetValuesDict
             game_outcomes = []
-            for _, _, target_vals, _ in dataset:
+            for sample in dataset:
+                target_vals = sample[2]
                 if 'v_win' in target_vals:
                     game_outcomes.append(target_vals['v_win'])
             
@@ -288,7 +468,10 @@ def self_train(
                 learning_rate=learning_rate,
                 policy_loss_weights=policy_loss_weights,
                 value_loss_weights=value_loss_weights,
-                gradient_clipping_norm=gradient_clipping_norm
+                gradient_clipping_norm=gradient_clipping_norm,
+                effective_batch_size=effective_batch_size,
+                lr_scaling=lr_scaling,
+                checkpointing=checkpointing
             )
 
             log_message = f"Iteration {iteration_idx + 1} training complete. Avg Losses: "
@@ -296,19 +479,66 @@ def self_train(
                 log_message += f"{loss_name}={avg_loss_val:.4f}; "
             logger.info(log_message.strip("; "))
 
-            if filename:
+            # A gate rejection on rank 0 reaches the other ranks with the next broadcast_state
+            if filename and distributed.is_main():
                 current_filename = f"{filename}-iter{iteration_idx + 1}.zip"
                 latest_filename = f"{filename}-latest.zip"
                 torch.save(net.state_dict(), current_filename)
-                torch.save(net.state_dict(), latest_filename)
-                logger.info(f"Saved model to {current_filename} and {latest_filename}")
+                logger.info(f"Saved model to {current_filename}")
+
+                promote = True
+                if gate_games > 0 and workers > 0 and config and path.exists(latest_filename):
+                    from arena import evaluate_candidate
+                    best = load(latest_filename, config, len(net.res_blocks))
+                    score = evaluate_candidate(net, best, config, gate_games, workers, n_sims, cPuct)
+                    promote = score >= gate_threshold
+                    logger.info(f"Arena score {score:.3f} over {gate_games} games (threshold {gate_threshold})")
+                    if not promote:
+                        # Keep generating self-play from the current best
+                        net.load_state_dict(best.state_dict())
+                        logger.info(f"Rejected {current_filename}, continuing from {latest_filename}")
+
+                if promote:
+                    torch.save(net.state_dict(), latest_filename)
+                    export_inference(net, f"{filename}-latest")
+                    logger.info(f"Promoted {current_filename} to {latest_filename}")
 
         except Exception as e:
             logger.exception(f"Exception during iteration {iteration_idx + 1}") # logger.exception includes stack trace
+            if distributed.is_distributed():
+                # A rank skipping the rest of an iteration would pair its next broadcasts and
+                # all-reduces with the wrong ones of the other ranks, stop the whole group instead
+                raise
+
+def train_options(data: dict) -> dict:
+    """self_train keyword arguments from a train command (see main.py), with its defaults."""
+    return dict(
+        iterations=data.get('iterations', 1000),
+        n_games=data.get('n_games', 3),
+        epochs=data.get('epochs', 100),
+        n_sims=data.get('n_sims', 1000),
+        temperature=data.get('temperature', 0.7),
+        cPuct=data.get('cPuct', 1.0),
+        gamma=data.get('gamma', 0.997),
+        deterministic=data.get('deterministic', False),
+        batch_size=data.get('batch_size', 16),
+        dirichlet=data.get('dirichlet', True),
+        rollouts=data.get('rollouts', 50),
+        settings=data.get('settings', {}),
+        workers=data.get('workers', 0),
+        gate_games=data.get('gate_games', 0),
+        gate_threshold=data.get('gate_threshold', 0.55),
+        trajectory_dir=data.get('trajectory_dir'),
+        dedup=data.get('dedup', True),
+        effective_batch_size=data.get('effective_batch_size'),
+        lr_scaling=data.get('lr_scaling', 'sqrt'),
+        checkpointing=data.get('checkpointing', False),
+    )
 
 def request_train(*args, **kwargs):
     logger.info(f"Sending training request to server with args: {args}, kwargs: {kwargs}")
     try:
+        from requests import post # Training only, keeps it off the predictor's startup path
         response = post("http://localhost:3000/train", json=kwargs.get('json', args[0] if args else {}))
         response.raise_for_status()
         logger.info(f"Training request successful. Response: {response.json()}")
@@ -327,6 +557,7 @@ def request_self_play(n_games: int, n_sims: int, temperature: float, cPuct: floa
         "dirichlet": dirichlet, "rollouts": rollouts, "settings": settings,
     }
     try:
+        from requests import post
         response = post("http://localhost:3000/selfplay", json=payload)
         response.raise_for_status()
         data = response.json()
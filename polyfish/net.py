@@ -1,6 +1,37 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+# Output keys, in forward's order
+HEADS = ('pi_action', 'pi_source', 'pi_target', 'pi_struct', 'pi_skill', 'pi_unit', 'pi_tech', 'pi_reward', 'v_win')
+# Heads computed from the pooled policy latent
+LATENT_POLICY_HEADS = ('pi_action', 'pi_struct', 'pi_skill', 'pi_unit', 'pi_tech', 'pi_reward')
+
+def _checkpointed(module):
+    """
+    module for torch.utils.checkpoint: the first call is the real forward, any later one the
+    recomputation in backward, run with BatchNorm momentum 0 and num_batches_tracked restored
+    so the running stats are only updated once per step.
+    """
+    calls = 0
+    def run(*inputs):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            return module(*inputs)
+        norms = [m for m in module.modules() if isinstance(m, nn.BatchNorm2d) and m.track_running_stats]
+        momenta = [m.momentum for m in norms]
+        tracked = [m.num_batches_tracked.clone() for m in norms]
+        for m in norms:
+            m.momentum = 0.0
+        try:
+            return module(*inputs)
+        finally:
+            for m, momentum, count in zip(norms, momenta, tracked):
+                m.momentum = momentum
+                m.num_batches_tracked.copy_(count)
+    return run
 
 class ResidualBlock(nn.Module):
     def __init__(self, num_channels):
@@ -40,6 +71,10 @@ class PolytopiaNet(nn.Module):
 
         self.dim_map_size = dim_map_size
         self.num_hidden_channels = num_hidden_channels
+        # Recompute the residual blocks' activations in backward instead of storing them
+        self.checkpointing = False
+        # Bumped on every weight update, invalidating features cached from the old weights
+        self.weights_version = 0
 
         # Calculate total number of options across all types
         self.num_option_total = dim_struct + dim_skill + dim_unit
@@ -112,17 +147,38 @@ class PolytopiaNet(nn.Module):
         # # v_mil: Predicted future military strength (normalized)
         # self.v_mil_fc = nn.Linear(num_hidden_channels, 1)
 
-    def forward(self, obs):
-        map_input = obs['map'] # [B, C_map, H, W]
-        player_input = obs['player'] # [B, C_player]
-        batch_size = map_input.size(0)
-        map_h, map_w = map_input.size(2), map_input.size(3)
+    def load_state_dict(self, *args, **kwargs):
+        result = super().load_state_dict(*args, **kwargs)
+        self.weights_version += 1
+        return result
 
+    def forward(self, obs, heads=HEADS):
+        return self.heads_from_features(self.encode_map(obs['map']), obs['player'], heads)
+
+    def encode_map(self, map_input):
+        """
+        Runs the map [B, C_map, H, W] through the CNN backbone, which does not see the player vector.
+        Returns:
+            spatial features [B, num_hidden, H, W], reusable with heads_from_features
+        """
         # 1. & 2. Process Map through CNN Backbone
         spatial_features = self.initial_conv(map_input)
         spatial_features = self.initial_bn(spatial_features)
         spatial_features = self.initial_relu(spatial_features)
-        spatial_features = self.res_blocks(spatial_features)
+        if self.checkpointing and self.training:
+            # One segment per block, only the block inputs are kept for backward
+            for block in self.res_blocks:
+                spatial_features = checkpoint(_checkpointed(block), spatial_features, use_reentrant=False)
+            return spatial_features
+        return self.res_blocks(spatial_features)
+
+    def heads_from_features(self, spatial_features, player_input, heads=HEADS):
+        """
+        Fuses encode_map features with the player vector [B, C_player] and runs the heads.
+        Only the output keys in heads are computed and returned.
+        """
+        batch_size = spatial_features.size(0)
+        map_h, map_w = spatial_features.size(2), spatial_features.size(3)
 
         # 3. Process Player State
         player_embed = self.player_fc1(player_input)
@@ -137,60 +193,61 @@ class PolytopiaNet(nn.Module):
         fused_features = self.fusion_relu(fused_features)
 
         # [B, num_hidden, H, W] 
-        shared_representation = self.post_fusion_resblock(fused_features) 
+        if self.checkpointing and self.training:
+            shared_representation = checkpoint(_checkpointed(self.post_fusion_resblock), fused_features, use_reentrant=False)
+        else:
+            shared_representation = self.post_fusion_resblock(fused_features) 
+
+        output = {}
 
         # --- Policy Head ---
-        # [B, num_hidden]
-        policy_pooled = self.policy_pool(shared_representation).view(batch_size, -1) 
-        policy_latent = self.policy_fc_shared(policy_pooled)
-        # [B, num_hidden]
-        policy_latent = self.policy_fc_relu(policy_latent) 
+        if any(key in heads for key in LATENT_POLICY_HEADS):
+            # [B, num_hidden]
+            policy_pooled = self.policy_pool(shared_representation).view(batch_size, -1) 
+            policy_latent = self.policy_fc_shared(policy_pooled)
+            # [B, num_hidden]
+            policy_latent = self.policy_fc_relu(policy_latent) 
 
         # π_action logits (categorical)
-        pi_action_logits = self.pi_action_fc(policy_latent)
+        if 'pi_action' in heads:
+            output['pi_action'] = self.pi_action_fc(policy_latent)
 
         # π_actor logits (spatial)
-        pi_actor_logits_map = self.pi_actor_conv(shared_representation)
-        pi_actor_logits = pi_actor_logits_map.view(batch_size, -1) # [B, H * W]
+        if 'pi_source' in heads:
+            output['pi_source'] = self.pi_actor_conv(shared_representation).view(batch_size, -1) # [B, H * W]
 
         # π_target logits (spatial)
-        pi_target_logits_map = self.pi_target_conv(shared_representation)
-        pi_target_logits = pi_target_logits_map.view(batch_size, -1) # [B, H * W]
+        if 'pi_target' in heads:
+            output['pi_target'] = self.pi_target_conv(shared_representation).view(batch_size, -1) # [B, H * W]
 
         # Separate π_option logits (categorical)
-        pi_option_struct_logits = self.pi_option_struct_fc(policy_latent) # [B, dim_struct]
-        pi_option_skill_logits = self.pi_option_skill_fc(policy_latent) # [B, dim_skill]
-        pi_option_unit_logits = self.pi_option_unit_fc(policy_latent) # [B, dim_unit]
+        if 'pi_struct' in heads:
+            output['pi_struct'] = self.pi_option_struct_fc(policy_latent) # [B, dim_struct]
+        if 'pi_skill' in heads:
+            output['pi_skill'] = self.pi_option_skill_fc(policy_latent) # [B, dim_skill]
+        if 'pi_unit' in heads:
+            output['pi_unit'] = self.pi_option_unit_fc(policy_latent) # [B, dim_unit]
 
         # π_tech logits
-        pi_tech_logits = self.pi_tech_fc(policy_latent) # [B, dim_tech]
+        if 'pi_tech' in heads:
+            output['pi_tech'] = self.pi_tech_fc(policy_latent) # [B, dim_tech]
 
         # π_reward_choice logits
         # Logit < 0 -> choose option 0 (first presented)
         # Logit > 0 -> choose option 1 (second presented)
-        pi_reward_logits = self.pi_reward_fc(policy_latent) # [B, 1]
+        if 'pi_reward' in heads:
+            output['pi_reward'] = self.pi_reward_fc(policy_latent) # [B, 1]
 
         # --- Value Head ---
-        value_pooled = self.value_pool(shared_representation).view(batch_size, -1)
-        value_latent = self.value_fc_shared(value_pooled)
-        value_latent = self.value_fc_relu(value_latent)
+        if 'v_win' in heads:
+            value_pooled = self.value_pool(shared_representation).view(batch_size, -1)
+            value_latent = self.value_fc_shared(value_pooled)
+            value_latent = self.value_fc_relu(value_latent)
 
-        v_win = torch.tanh(self.v_win_fc(value_latent))
+            output['v_win'] = torch.tanh(self.v_win_fc(value_latent))
 
         # v_eco = self.v_eco_fc(value_latent)
 
         # v_mil = self.v_mil_fc(value_latent)
 
-        return {
-            'pi_action': pi_action_logits,
-            'pi_source': pi_actor_logits,
-            'pi_target': pi_target_logits,
-            'pi_struct': pi_option_struct_logits,
-            'pi_skill': pi_option_skill_logits,
-            'pi_unit': pi_option_unit_logits,
-            'pi_tech': pi_tech_logits,
-            'pi_reward': pi_reward_logits,
-            'v_win': v_win,
-            # 'v_eco': v_eco,
-            # 'v_mil': v_mil
-        }
\ No newline at end of file
+        return output
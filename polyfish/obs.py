@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+
+# Observation maps travel either dense, as [C, H, W] nested lists / arrays, or sparse as
+#   { 'shape': [C, H, W], 'indices': [flat index of each nonzero], 'values': [...] }
+# 'values' may be omitted when every nonzero is 1, the common case for the one-hot planes.
+
+def is_sparse(map_obs) -> bool:
+    return isinstance(map_obs, dict)
+
+def encode_sparse(map_obs) -> dict:
+    """Encodes a dense [C, H, W] map observation sparsely."""
+    array = np.asarray(map_obs, dtype=np.float32)
+    flat = array.reshape(-1)
+    indices = np.flatnonzero(flat)
+    encoded = { 'shape': list(array.shape), 'indices': indices.tolist() }
+    values = flat[indices]
+    if not np.all(values == 1):
+        encoded['values'] = values.tolist()
+    return encoded
+
+def decode_sparse(map_obs: dict) -> np.ndarray:
+    array = np.zeros(int(np.prod(map_obs['shape'])), dtype=np.float32)
+    array[map_obs['indices']] = map_obs.get('values', 1.0)
+    return array.reshape(map_obs['shape'])
+
+def collate_maps(maps: list, device: torch.device) -> torch.Tensor:
+    """
+    Stacks dense and/or sparse map observations into a [B, C, H, W] float32 tensor.
+    Sparse maps are expanded on device with a single index_put over the whole batch.
+    """
+    sparse_rows = [i for i, map_obs in enumerate(maps) if is_sparse(map_obs)]
+    if not sparse_rows:
+        return torch.tensor(np.array(maps), dtype=torch.float32, device=device)
+
+    shape = maps[sparse_rows[0]]['shape']
+    plane_size = int(np.prod(shape))
+    batch = torch.zeros((len(maps), plane_size), dtype=torch.float32, device=device)
+
+    dense_rows = [i for i, map_obs in enumerate(maps) if not is_sparse(map_obs)]
+    if dense_rows:
+        batch[dense_rows] = torch.tensor(
+            np.array([maps[i] for i in dense_rows]), dtype=torch.float32, device=device
+        ).view(len(dense_rows), plane_size)
+
+    rows = np.concatenate([np.full(len(maps[i]['indices']), i) for i in sparse_rows])
+    columns = np.concatenate([np.asarray(maps[i]['indices'], dtype=np.int64) for i in sparse_rows])
+    values = np.concatenate([
+        np.asarray(maps[i]['values'], dtype=np.float32) if 'values' in maps[i] else np.ones(len(maps[i]['indices']), dtype=np.float32)
+        for i in sparse_rows
+    ])
+    batch.index_put_(
+        (torch.from_numpy(rows).to(device), torch.from_numpy(columns).to(device)),
+        torch.from_numpy(values).to(device)
+    )
+    return batch.view(len(maps), *shape)
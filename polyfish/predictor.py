@@ -1,86 +1,424 @@
 import threading
+import queue
 import time
+import hashlib
+from collections import OrderedDict, deque
 import numpy as np
 import torch
 import torch.nn.functional as F
+from metrics import metrics, ProfilerWindow
+from net import HEADS
+from action import NET_HEAD_KEYS, NUM_HEADS, encode_valid_moves, check_move_indices, net_output_to_predictions, score_moves, move_priors
 
 # 1) Configuration
 MAX_BATCH = 64        # max number of obs to batch
 MAX_DELAY = 0.001      # max time (s) to wait for a batch
+FEATURE_CACHE_SIZE = 1024  # backbone feature maps kept, ~62KB each at 128x11x11
+MAX_QUEUE = 4096      # max requests waiting across all lanes, 0 for unbounded
+NUM_BUFFERS = 2       # input buffers, one being filled while the other is in the forward pass
+BUCKETS = (1, 8, 16, 32, MAX_BATCH)  # batch sizes compiled for, batches are padded up to one
+
+# Priority lanes, each batch is packed from the lower lanes first
+PRIORITY_HIGH = 0      # interactive predicts
+PRIORITY_NORMAL = 1    # self-play and other bulk evaluations
+PRIORITIES = { 'high': PRIORITY_HIGH, 'normal': PRIORITY_NORMAL }
+
+class QueueFull(Exception):
+    pass
+
+class DeadlineExceeded(Exception):
+    pass
+
+def bucket_size(n: int) -> int:
+    return next((size for size in BUCKETS if size >= n), n)
+
+def map_key(map_tensor) -> bytes:
+    """Digest of a [1, C, S, S] map tensor, the feature cache key."""
+    return hashlib.blake2b(map_tensor.detach().cpu().numpy().tobytes(), digest_size=16).digest()
+
+class FeatureCache:
+    """
+    LRU of PolytopiaNet.encode_map outputs keyed by map_key, so positions differing from a
+    cached one only in the player vector skip the residual tower.
+    Entries belong to one weights_version of the net, see sync.
+    Only touched by the batcher forward thread.
+    """
+    def __init__(self, max_size: int = FEATURE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.version = None
+
+    def sync(self, version):
+        """Drops every entry once the weights changed (trained or reloaded in place)."""
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key):
+        features = self.entries.get(key)
+        if features is not None:
+            self.entries.move_to_end(key)
+        return features
+
+    def put(self, key, features):
+        self.entries[key] = features
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
 
 # 2) A simple request object that callers block on
 class BatchRequest:
-    def __init__(self, obs_tensor):
+    def __init__(self, obs_tensor, key=None, heads=HEADS, moves=None, group=None, priority=PRIORITY_NORMAL, deadline=None):
         self.obs = obs_tensor
+        self.key = key  # map_key of obs['map'], None when caching is off
+        self.heads = heads  # net output keys to compute, in HEADS order
+        self.moves = moves  # [M, NUM_HEADS] encoded legal moves to return priors for, or None
+        self.group = group  # RequestGroup to notify once done
+        self.priority = priority  # lane index
+        self.deadline = deadline  # time.perf_counter() after which the request is dropped, or None
         self.event = threading.Event()
-        self.result = None  # will hold (pi, v)
+        self.result = None  # will hold the net output keys, pi_* as probabilities
+        self.error = None  # or the exception it failed with
+
+    def finish(self, result=None, error=None):
+        self.result, self.error = result, error
+        self.event.set()
+        if self.group is not None:
+            self.group.done()
+
+class RequestGroup:
+    """
+    Requests submitted together, calling back with (results, first error or None) once the
+    last is done.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+        self.remaining = 0
+        self.lock = threading.Lock()  # expired and completed requests finish on different threads
+
+    def done(self):
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last:
+            error = next((req.error for req in self.requests if req.error is not None), None)
+            self.callback([req.result for req in self.requests], error)
 
 # 3) The batcher
 class PredictorBatcher:
-    def __init__(self, model):
+    def __init__(self, model, feature_cache_size=FEATURE_CACHE_SIZE, max_queue=MAX_QUEUE, compile=False):
         self.model = model
+        # Output size of each move scoring head, in NET_HEAD_KEYS order
+        tiles = model.dim_map_size ** 2
+        self.head_widths = torch.tensor([
+            model.pi_action_fc.out_features, tiles, tiles,
+            model.pi_option_struct_fc.out_features, model.pi_option_skill_fc.out_features,
+            model.pi_option_unit_fc.out_features, model.pi_tech_fc.out_features,
+        ])
+        # Opt-in torch.compile of the backbone, one static graph per bucket size. The heads stay
+        # eager: every head mask and move scoring group would be a graph of its own per bucket
+        self.compiled = compile
+        self.encode_map = torch.compile(model.encode_map, dynamic=False) if compile else model.encode_map
+        self.compile_report = self._compile_buckets() if compile else None
+        # Backbone feature cache, 0 disables it
+        self.features = FeatureCache(feature_cache_size) if feature_cache_size > 0 else None
+        self.max_queue = max_queue
         self.lock = threading.Lock()
-        self.queue = []  # list of BatchRequest
-        self.thread = threading.Thread(target=self._worker, daemon=True)
-        self.thread.start()
+        self.space = threading.Condition(self.lock)  # notified when the worker dequeues
+        self.lanes = [deque() for _ in PRIORITIES]  # BatchRequests per priority
+        self.queued = 0
+        self.profile_request = None  # (n_batches, filename) for the worker to pick up
+        self.profiler = None  # active ProfilerWindow, owned by the forward thread
 
-    def predict(self, obs_tensor):
-        # Called by main thread for each incoming predict
-        req = BatchRequest(obs_tensor)
-        with self.lock:
-            self.queue.append(req)
+        # Pipeline: collate batch k+1 into a free buffer while batch k runs forward and
+        # batch k-1 is scattered back to its requests
+        self.buffers = [None] * NUM_BUFFERS  # { 'map'?, 'player' } [MAX_BATCH, ...] tensors
+        self.free_buffers = queue.Queue()
+        for slot in range(NUM_BUFFERS):
+            self.free_buffers.put(slot)
+        self.forward_queue = queue.Queue()
+        self.scatter_queue = queue.Queue(maxsize=NUM_BUFFERS)
+        self.threads = [
+            threading.Thread(target=worker, daemon=True)
+            for worker in (self._collate_worker, self._forward_worker, self._scatter_worker)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def predict(self, obs_tensor, heads=HEADS, moves=None, priority=PRIORITY_NORMAL, timeout=None):
+        # Called by main thread for each incoming predict, heads selecting the outputs to compute.
+        # With legal moves (dicts or packed ints) the result also holds 'priors', one per move.
+        return self.predict_batch([obs_tensor], heads, [moves], priority, timeout)[0]
+
+    def predict_batch(self, obs_tensors, heads=HEADS, moves=None, priority=PRIORITY_NORMAL, timeout=None):
+        # Queues every observation at once, so they share forward passes with each other and
+        # with any concurrent predicts, moves[i] being the legal moves of obs_tensors[i] or None.
+        # Raises QueueFull or DeadlineExceeded when not done within timeout seconds.
+        reqs = self.submit(obs_tensors, heads, moves, priority=priority, timeout=timeout)
+        # Wait for the background worker to fill every req.result
+        for req in reqs:
+            req.event.wait()
+            if req.error is not None:
+                raise req.error
+        return [req.result for req in reqs]
+
+    def submit(self, obs_tensors, heads=HEADS, moves=None, callback=None, priority=PRIORITY_NORMAL, timeout=None, block=True):
+        # Non-blocking predict_batch, callback(results, error) running on a worker thread once
+        # done. A full queue blocks until there is room (up to timeout), or raises QueueFull
+        # right away without block. Raises ValueError on moves that cannot be scored.
+        heads = tuple(key for key in HEADS if key in heads)
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        group = RequestGroup(callback) if callback is not None else None
+        reqs = []
+        for i, obs_tensor in enumerate(obs_tensors):
+            obs_moves = moves[i] if moves is not None else None
+            if obs_moves is not None:
+                obs_moves = encode_valid_moves([obs_moves], self.model.dim_map_size, obs_tensor['player'].device)[0]
+                check_move_indices(obs_moves, self.head_widths)
+            key = map_key(obs_tensor['map']) if self.features is not None else None
+            reqs.append(BatchRequest(obs_tensor, key, heads, obs_moves, group, priority, deadline))
+        if group is not None:
+            group.requests, group.remaining = reqs, len(reqs)
+            if not reqs:
+                callback([], None)
+
+        # An oversized submit still goes through once the queue is empty
+        fits = lambda: not self.max_queue or self.queued == 0 or self.queued + len(reqs) <= self.max_queue
+        with self.space:
+            if not fits():
+                wait = None if deadline is None else max(deadline - time.perf_counter(), 0)
+                if not block or not self.space.wait_for(fits, wait):
+                    metrics.inc('predict_rejected', len(reqs))
+                    raise QueueFull(f"Predict queue full ({self.queued}/{self.max_queue})")
+            self.lanes[priority].extend(reqs)
+            self.queued += len(reqs)
             # If we hit max batch size, wake the worker immediately
-            if len(self.queue) >= MAX_BATCH:
+            if self.queued >= MAX_BATCH:
                 # Notify by setting a flag or simply let worker see
                 pass
-        # Wait for the background worker to fill this req.result
-        req.event.wait()
-        return req.result
+        return reqs
+
+    def profile(self, n_batches, filename):
+        # Opt-in torch.profiler capture of the next n_batches forward passes
+        with self.lock:
+            self.profile_request = (n_batches, filename)
+
+    def _next_batch(self):
+        # Pops up to MAX_BATCH requests, highest priority first, failing expired ones
+        with self.lock:
+            if not self.queued:
+                return []
+            metrics.observe('predict_queue_depth', self.queued)
+            now = time.perf_counter()
+            batch, expired = [], []
+            for lane in self.lanes:
+                while lane and len(batch) < MAX_BATCH:
+                    req = lane.popleft()
+                    (expired if req.deadline is not None and req.deadline < now else batch).append(req)
+            self.queued -= len(batch) + len(expired)
+            self.space.notify_all()
+
+        if expired:
+            metrics.inc('predict_expired', len(expired))
+            for req in expired:
+                req.finish(error=DeadlineExceeded("Predict deadline exceeded"))
+        return batch
+
+    def _buffer(self, slot, obs):
+        # Input buffers are allocated once, on the device and with the shapes of the requests
+        # With the feature cache the maps are gathered from its hits and misses instead
+        keys = ('map', 'player') if self.features is None else ('player',)
+        buffer = self.buffers[slot]
+        if buffer is None or any(buffer[key].shape[1:] != obs[key].shape[1:] for key in keys):
+            buffer = self.buffers[slot] = {
+                key: torch.empty((MAX_BATCH, *obs[key].shape[1:]), dtype=obs[key].dtype, device=obs[key].device)
+                for key in keys
+            }
+        return buffer
 
-    def _worker(self):
+    def _collate_worker(self):
         while True:
-            time.sleep(MAX_DELAY)  # small delay to gather requests
-            with self.lock:
-                if not self.queue:
-                    continue
-                # Pop up to MAX_BATCH requests
-                batch, self.queue = self.queue[:MAX_BATCH], self.queue[MAX_BATCH:]
+            # Take the buffer first, so the batch keeps filling while the forward pass runs
+            slot = self.free_buffers.get()
+            batch = []
+            while not batch:
+                time.sleep(MAX_DELAY)  # small delay to gather requests
+                batch = self._next_batch()
 
             # Build a batched input
-            batched_map = torch.cat([r.obs['map'] for r in batch], dim=0)       # [B, C, S, S]
-            batched_player = torch.cat([r.obs['player'] for r in batch], dim=0) # [B, T]
-
-            # Run one forward pass
-            with torch.no_grad():
-                output = self.model({
-                    'map': batched_map,
-                    'player': batched_player
-                })
-                pi_action = F.softmax(output['pi_action_logits'], dim=-1)
-                pi_actor = F.softmax(output['pi_actor_logits'], dim=-1)
-                pi_target = F.softmax(output['pi_target_logits'], dim=-1)
-                pi_option_struct = F.softmax(output['pi_option_struct_logits'], dim=-1)
-                pi_option_skill = F.softmax(output['pi_option_skill_logits'], dim=-1)
-                pi_option_unit = F.softmax(output['pi_option_unit_logits'], dim=-1)
-                pi_option_tech = F.softmax(output['pi_tech_logits'], dim=-1)
-                pi_option_reward = torch.sigmoid(output['pi_reward_logits'])
-                v_win = output['v_win'].cpu().numpy()
-                v_eco = output['v_eco'].cpu().numpy()
-                v_mil = output['v_mil'].cpu().numpy()
+            collate_start = time.perf_counter()
+            n = len(batch)
+            try:
+                buffer = self._buffer(slot, batch[0].obs)
+                torch.cat([r.obs['player'] for r in batch], dim=0, out=buffer['player'][:n]) # [B, T]
+                if self.features is None:
+                    torch.cat([r.obs['map'] for r in batch], dim=0, out=buffer['map'][:n]) # [B, C, S, S]
+            except Exception as e:
+                # e.g. an observation of the wrong shape
+                self.free_buffers.put(slot)
+                self._fail(batch, e)
+                continue
+            metrics.observe('predict_collate_ms', (time.perf_counter() - collate_start) * 1000)
+            self.forward_queue.put((batch, slot))
+
+    def _forward_worker(self):
+        while True:
+            batch, slot = self.forward_queue.get()
+            metrics.observe('predict_batch_size', len(batch))
+            with self.lock:
+                if self.profile_request is not None and self.profiler is None:
+                    self.profiler = ProfilerWindow(*self.profile_request)
+                    self.profile_request = None
+
+            try:
+                batched_player = self.buffers[slot]['player'][:len(batch)]
+                # Requests grouped by head mask and whether they score moves,
+                # the backbone still runs once for the whole batch
+                groups = {}
+                for i, r in enumerate(batch):
+                    groups.setdefault((r.heads, r.moves is not None), []).append(i)
+
+                # Run one forward pass
+                forward_start = time.perf_counter()
+                outputs = []
+                with torch.no_grad():
+                    if self.features is None:
+                        spatial_features = self._run(self.encode_map, self.buffers[slot]['map'][:len(batch)])
+                    else:
+                        spatial_features = self._spatial_features(batch)
+                    for (heads, scored), rows in groups.items():
+                        if len(groups) == 1:
+                            group_features, group_player = spatial_features, batched_player
+                        else:
+                            index = torch.tensor(rows, device=batched_player.device)
+                            group_features, group_player = spatial_features[index], batched_player[index]
+                        net_heads = tuple(key for key in HEADS if key in heads or (scored and key in NET_HEAD_KEYS))
+                        output = self.model.heads_from_features(group_features, group_player, heads=net_heads)
+                        priors = self._move_priors([batch[i].moves for i in rows], output) if scored else None
+                        # Policy logits to probabilities, pi_reward being a binary choice
+                        output = {
+                            key: (torch.sigmoid(value) if key == 'pi_reward' else F.softmax(value, dim=-1)) if key.startswith('pi_') else value
+                            for key, value in output.items() if key in heads
+                        }
+                        outputs.append((rows, {key: value.cpu() for key, value in output.items()}, priors))
+            except Exception as e:
+                # e.g. a request the net cannot evaluate, only its batch fails
+                self._fail(batch, e)
+                continue
+            finally:
+                # Outputs are on the CPU, the buffer is no longer read
+                self.free_buffers.put(slot)
+            metrics.observe('predict_forward_ms', (time.perf_counter() - forward_start) * 1000)
+
+            if self.profiler is not None and self.profiler.step():
+                self.profiler = None
+
+            self.scatter_queue.put((batch, outputs))
+
+    def _scatter_worker(self):
+        while True:
+            batch, outputs = self.scatter_queue.get()
 
             # Scatter results back to requests
-            for i, req in enumerate(batch):
-                req.result = (
-                    [_.item() for _ in pi_action[i]], 
-                    [_.item() for _ in pi_actor[i]], 
-                    [_.item() for _ in pi_target[i]], 
-                    [_.item() for _ in pi_option_struct[i]], 
-                    [_.item() for _ in pi_option_skill[i]], 
-                    [_.item() for _ in pi_option_unit[i]], 
-                    [_.item() for _ in pi_option_tech[i]], 
-                    [_.item() for _ in pi_option_reward[i]], 
-                    v_win[i].item(),
-                    v_eco[i].item(),
-                    v_mil[i].item()
-                )
-                req.event.set()
+            scatter_start = time.perf_counter()
+            try:
+                for rows, output, priors in outputs:
+                    output = {key: value.tolist() for key, value in output.items()}
+                    priors = priors.tolist() if priors is not None else None
+                    for j, i in enumerate(rows):
+                        result = {
+                            key: values[j][0] if key.startswith('v_') else values[j]
+                            for key, values in output.items()
+                        }
+                        if priors is not None:
+                            result['priors'] = priors[j][:batch[i].moves.size(0)]
+                        batch[i].finish(result)
+            except Exception as e:
+                self._fail(batch, e)
+                continue
+            metrics.observe('predict_scatter_ms', (time.perf_counter() - scatter_start) * 1000)
+            metrics.inc('predict_requests', len(batch))
+
+    def _fail(self, batch, error):
+        # Fails the requests of a batch a worker could not process, the worker moves on
+        pending = [req for req in batch if not req.event.is_set()]
+        metrics.inc('predict_errors', len(pending))
+        for req in pending:
+            req.finish(error=error)
+
+    def _run(self, fn, *inputs, **kwargs):
+        # Calls an (optionally compiled) half of the net, compiled graphs getting their batch
+        # padded with zero rows up to a bucket size, the padded rows are dropped from the output
+        n = inputs[0].size(0)
+        size = bucket_size(n) if self.compiled else n
+        if size != n:
+            inputs = [torch.cat([x, x.new_zeros((size - n, *x.shape[1:]))]) for x in inputs]
+        output = fn(*inputs, **kwargs)
+        if size == n:
+            return output
+        return {key: value[:n] for key, value in output.items()} if isinstance(output, dict) else output[:n]
+
+    def _compile_buckets(self, repeats=20):
+        """
+        Compiles the backbone for every bucket up front and compares its steady-state latency
+        with eager mode.
+        Returns:
+            { 'compile_ms', 'buckets': { size: { 'eager_ms', 'compiled_ms' } } }
+        """
+        parameter = next(self.model.parameters())
+        size = self.model.dim_map_size
+        map_shape = (self.model.initial_conv.in_channels, size, size)
+
+        def _forward(encode_map, batch_size):
+            maps = torch.zeros((batch_size, *map_shape), dtype=parameter.dtype, device=parameter.device)
+            return encode_map(maps)
+
+        def _time(encode_map, batch_size):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                _forward(encode_map, batch_size)
+            return (time.perf_counter() - start) * 1000 / repeats
+
+        report = { 'compile_ms': 0.0, 'buckets': {} }
+        with torch.no_grad():
+            for batch_size in BUCKETS:
+                start = time.perf_counter()
+                _forward(self.encode_map, batch_size)
+                report['compile_ms'] += (time.perf_counter() - start) * 1000
+                report['buckets'][batch_size] = {
+                    'eager_ms': _time(self.model.encode_map, batch_size),
+                    'compiled_ms': _time(self.encode_map, batch_size),
+                }
+        metrics.observe('compile_ms', report['compile_ms'])
+        return report
+
+    def _move_priors(self, moves, output):
+        # Legal move priors from the raw logits, scored for every request of the group at once
+        move_indices = torch.full((len(moves), max(m.size(0) for m in moves), NUM_HEADS), -1, dtype=torch.long, device=moves[0].device)
+        for row, encoded in enumerate(moves):
+            move_indices[row, :encoded.size(0)] = encoded
+        return move_priors(score_moves(net_output_to_predictions(output), move_indices)).cpu()
+
+    def _spatial_features(self, batch):
+        # Backbone features for the batch, running the tower only on maps not in the cache.
+        # Read before encoding, so features of weights updated meanwhile are dropped next batch
+        self.features.sync(self.model.weights_version)
+        features, missing = {}, {}
+        for r in batch:
+            if r.key in features or r.key in missing:
+                continue
+            cached = self.features.get(r.key)
+            if cached is None:
+                missing[r.key] = r.obs['map']
+            else:
+                features[r.key] = cached
+        metrics.inc('cache_hits', len(batch) - len(missing))
+        metrics.inc('cache_misses', len(missing))
+        if missing:
+            encoded = self._run(self.encode_map, torch.cat(list(missing.values()), dim=0))
+            for key, map_features in zip(missing, encoded):
+                features[key] = map_features
+                # A copy, the row view would keep the whole encoded batch alive
+                self.features.put(key, map_features.clone())
+        return torch.stack([features[r.key] for r in batch])
@@ -0,0 +1,150 @@
+import queue
+import time
+import numpy as np
+import torch
+import multiprocessing as mp
+import model
+from game import StandInGame
+from mcts import MCTS, NetEvaluator, play_game_record
+from trajectories import TrajectoryStore, record_to_dataset
+from predictor import MAX_BATCH, MAX_DELAY
+
+# Workers only walk trees and step games, the inference server owns the torch threads
+WORKER_THREADS = 1
+
+class QueueEvaluator:
+    """MCTS evaluator that forwards leaf batches to the shared inference server."""
+    def __init__(self, worker_id: int, request_queue, response_queue):
+        self.worker_id = worker_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+
+    def __call__(self, observations: list[dict], legal_moves: list[list[int]]):
+        self.request_queue.put((self.worker_id, observations, legal_moves))
+        return self.response_queue.get()
+
+def inference_server(state_dict, config, n_res_blocks, request_queue, response_queues, max_batch, max_delay):
+    net = model.build(config, n_res_blocks)
+    net.load_state_dict(state_dict)
+    net.eval()
+    evaluator = NetEvaluator(net, config['dim_map_size'], model.device)
+
+    running = True
+    while running:
+        request = request_queue.get()
+        if request is None:
+            break
+
+        # Merge leaf batches from several workers into one forward pass
+        requests = [request]
+        n_leaves = len(request[1])
+        deadline = time.monotonic() + max_delay
+        while n_leaves < max_batch:
+            try:
+                request = request_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if request is None:
+                running = False
+                break
+            requests.append(request)
+            n_leaves += len(request[1])
+
+        priors, values = evaluator(
+            [obs for _, observations, _ in requests for obs in observations],
+            [moves for _, _, legal_moves in requests for moves in legal_moves],
+        )
+
+        offset = 0
+        for worker_id, observations, _ in requests:
+            count = len(observations)
+            response_queues[worker_id].put((priors[offset:offset + count], values[offset:offset + count]))
+            offset += count
+
+def _self_play_worker(worker_id, config, mcts_settings, task_queue, result_queue, request_queue, response_queue):
+    torch.set_num_threads(WORKER_THREADS)
+    mcts = MCTS(StandInGame(config), QueueEvaluator(worker_id, request_queue, response_queue), **mcts_settings)
+    while True:
+        seed = task_queue.get()
+        if seed is None:
+            break
+        mcts.rng = np.random.default_rng(seed)
+        result_queue.put(play_game_record(mcts, config, seed))
+
+def self_play_pool(
+    net, config: dict, n_games: int, n_workers: int,
+    n_sims: int, temperature: float, cPuct: float, gamma: float, dirichlet: bool,
+    batch_size: int = 32, base_seed: int | None = None,
+    max_batch: int = MAX_BATCH, max_delay: float = MAX_DELAY,
+    store: TrajectoryStore | None = None,
+) -> model.Dataset:
+    """
+    Plays n_games of local self-play over n_workers game processes, all leaf evaluations
+    being batched by a single inference process holding a copy of net.
+    Game i is seeded with base_seed + i, finished games are also added to store if given.
+    """
+    if base_seed is None:
+        base_seed = int(np.random.default_rng().integers(2 ** 31 - n_games))
+    n_workers = max(1, min(n_workers, n_games))
+    ctx = mp.get_context('spawn')
+
+    request_queue = ctx.Queue()
+    response_queues = [ctx.Queue() for _ in range(n_workers)]
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+
+    state_dict = {key: value.cpu() for key, value in net.state_dict().items()}
+    server = ctx.Process(
+        target=inference_server,
+        args=(state_dict, config, len(net.res_blocks), request_queue, response_queues, max_batch, max_delay),
+        daemon=True
+    )
+    mcts_settings = {
+        'n_sims': n_sims, 'cPuct': cPuct, 'temperature': temperature,
+        'dirichlet': dirichlet, 'batch_size': batch_size,
+    }
+    workers = [
+        ctx.Process(
+            target=_self_play_worker,
+            args=(i, config, mcts_settings, task_queue, result_queue, request_queue, response_queues[i]),
+            daemon=True
+        )
+        for i in range(n_workers)
+    ]
+
+    for seed in range(base_seed, base_seed + n_games):
+        task_queue.put(seed)
+    for _ in workers:
+        task_queue.put(None)
+
+    server.start()
+    for worker in workers:
+        worker.start()
+
+    dataset = []
+    finished = 0
+    try:
+        while finished < n_games:
+            try:
+                record = result_queue.get(timeout=1.0)
+                dataset.extend(record_to_dataset(record, gamma))
+                if store is not None:
+                    store.add_game(record)
+                finished += 1
+                model.logger.debug(f"Self-play game {finished}/{n_games} finished.")
+            except queue.Empty:
+                if not server.is_alive() or not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError(f"Self-play pool died after {finished}/{n_games} games")
+    finally:
+        request_queue.put(None)
+        for worker in workers:
+            worker.join(timeout=5.0)
+            if worker.is_alive():
+                worker.terminate()
+        server.join(timeout=5.0)
+        if server.is_alive():
+            server.terminate()
+        if store is not None:
+            store.flush()
+
+    return dataset
@@ -0,0 +1,181 @@
+import os
+import json
+import asyncio
+import threading
+import numpy as np
+import torch
+import model
+from net import HEADS
+from predictor import PRIORITIES
+from metrics import metrics
+from obs import collate_maps
+from client import parse_address
+
+# Requests a connection may have in flight before the server stops reading from it
+MAX_INFLIGHT = 64
+# Longest command line read, in bytes. asyncio's 64 KiB default is a handful of dense observations
+MAX_LINE = 64 * 1024 * 1024
+
+def obs_to_tensor(value: dict):
+    return {
+        'map': collate_maps([value['map']], model.device),
+        'player': torch.tensor(np.array(value['player'])).to(model.device).unsqueeze(0).float()
+    }
+
+def parse_predict(data: dict) -> tuple[list[dict], list[str], list, int, float | None]:
+    """
+    Parses a predict / predict_batch command.
+    Returns:
+        (observations, heads, moves per observation or None, priority lane, timeout in seconds or None)
+    Raises:
+        ValueError on unknown heads or priority
+    """
+    observations = data['observations'] if data['cmd'] == 'predict_batch' else [data]
+    moves = [obs.get('moves') for obs in observations]
+    # With legal moves the heads default to v_win alone, the priors replacing the distributions
+    heads = data.get('heads', HEADS if all(m is None for m in moves) else ['v_win'])
+    unknown = [key for key in heads if key not in HEADS]
+    if unknown:
+        raise ValueError(f"Unknown heads: {unknown}")
+    # 'priority': 'high' for interactive requests, 'timeout_ms' drops them once stale
+    priority = data.get('priority', 'normal')
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {priority}")
+    timeout = data['timeout_ms'] / 1000 if data.get('timeout_ms') is not None else None
+    return observations, heads, moves, PRIORITIES[priority], timeout
+
+async def _skip_line(reader: asyncio.StreamReader):
+    """Drops the rest of an overlong line, so its tail isn't read as the next command."""
+    while True:
+        try:
+            await reader.readuntil(b'\n')
+            return
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError:
+            return
+
+class InferenceServer:
+    """
+    Serves predict, predict_batch and stats over a TCP or Unix socket, one JSON command per
+    line, multiplexing every connection into the shared PredictorBatcher.
+    Replies are { 'id', 'result' } or { 'id', 'error' } lines, in completion order, 'id'
+    echoing the request's. A connection with max_inflight requests pending is not read
+    from until one completes, pushing back on the client through the socket buffers.
+    """
+    def __init__(self, predictor, max_inflight: int = MAX_INFLIGHT):
+        self.predictor = predictor
+        self.max_inflight = max_inflight
+        self.connections = 0
+
+    async def serve(self, address: str):
+        model.setup_logging()
+        family, target = parse_address(address)
+        if family == 'unix':
+            if os.path.exists(target):
+                os.remove(target)
+            server = await asyncio.start_unix_server(self._handle, path=target, limit=MAX_LINE)
+        else:
+            server = await asyncio.start_server(self._handle, *target, limit=MAX_LINE)
+        model.logger.info(f"Inference server listening on {address}")
+        async with server:
+            await server.serve_forever()
+
+    def start(self, address: str) -> threading.Thread:
+        """Serves from a daemon thread running its own event loop."""
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(address),), daemon=True)
+        thread.start()
+        return thread
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        inflight = asyncio.Semaphore(self.max_inflight)
+        write_lock = asyncio.Lock()
+        tasks = set()
+        self.connections += 1
+        metrics.observe('server_connections', self.connections)
+
+        async def send(reply):
+            async with write_lock:
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+
+        async def run(data):
+            try:
+                reply = { 'id': data.get('id'), 'result': await self._execute(loop, data) }
+            except Exception as e:
+                reply = { 'id': data.get('id'), 'error': str(e) }
+            finally:
+                inflight.release()
+            try:
+                await send(reply)
+            except ConnectionError:
+                pass
+
+        try:
+            while True:
+                await inflight.acquire()
+                try:
+                    line = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    line = e.partial
+                except asyncio.LimitOverrunError:
+                    await _skip_line(reader)
+                    inflight.release()
+                    await send({ 'id': None, 'error': f"Command longer than {MAX_LINE} bytes" })
+                    continue
+                if not line:
+                    break
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    inflight.release()
+                    await send({ 'id': None, 'error': 'Invalid JSON' })
+                    continue
+                task = asyncio.create_task(run(data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _execute(self, loop, data: dict):
+        cmd = data.get('cmd')
+        if cmd == 'stats':
+            return metrics.snapshot()
+        if cmd not in ('predict', 'predict_batch'):
+            raise ValueError(f"Unknown command: {cmd}")
+
+        future = loop.create_future()
+
+        def _set(results, error):
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results)
+
+        def _resolve(results, error):
+            # Runs on a batcher worker thread, the loop may be gone by then
+            try:
+                loop.call_soon_threadsafe(_set, results, error)
+            except RuntimeError:
+                pass
+
+        def _submit():
+            observations, heads, moves, priority, timeout = parse_predict(data)
+            # Never wait on a full queue either, the client gets an error instead
+            self.predictor.submit(
+                [obs_to_tensor(obs) for obs in observations], heads, moves, _resolve,
+                priority=priority, timeout=timeout, block=False
+            )
+
+        # Decoding a large predict_batch and encoding its moves would stall every connection
+        await loop.run_in_executor(None, _submit)
+        results = await future
+        return results if cmd == 'predict_batch' else results[0]
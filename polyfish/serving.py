@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+import torch
+import model
+from predictor import PredictorBatcher
+
+def parse_cpus(value: str) -> list[int]:
+    """Parses a taskset style cpu list, e.g. '0-3,8,10-11'."""
+    cpus = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def add_serving_args(parser: argparse.ArgumentParser, config: dict):
+    parser.add_argument('--threads', type=int, default=config.get('num_threads', 0), help='Intra-op threads, 0 keeps the torch default')
+    parser.add_argument('--interop-threads', type=int, default=config.get('num_interop_threads', 0), help='Inter-op threads, 0 keeps the torch default')
+    parser.add_argument('--cpus', type=str, default=config.get('cpu_affinity', ''), help="CPUs to pin to, e.g. '0-3,8'")
+    parser.add_argument('--compile', action=argparse.BooleanOptionalAction, default=config.get('compile', False), help='Serve a torch.compile graph of the backbone, one per batch size bucket')
+    parser.add_argument('--worker', type=int, default=None, help='Worker index, pins to cpus [worker * threads, (worker + 1) * threads) when --cpus is not given')
+
+def apply_serving_config(threads: int = 0, interop_threads: int = 0, cpus: str | list[int] = '', worker: int | None = None) -> dict:
+    """
+    Pins the process and sets the torch thread pools, call before the first torch op.
+    Returns:
+        The applied settings.
+    """
+    if isinstance(cpus, str):
+        cpus = parse_cpus(cpus)
+    if not cpus and worker is not None and threads > 0:
+        cpus = list(range(worker * threads, (worker + 1) * threads))
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop_threads > 0:
+        torch.set_num_interop_threads(interop_threads)
+    return {
+        'threads': torch.get_num_threads(),
+        'interop_threads': torch.get_num_interop_threads(),
+        'cpus': sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else [],
+    }
+
+def measure(config: dict, clients: int, seconds: float) -> dict:
+    """Predicts per second through a PredictorBatcher fed by `clients` concurrent callers."""
+    net = model.build(config, config.get('res_blocks', 12))
+    net.eval()
+    model.warmup(net, config)
+    # Every client repeats the same map, measure full forward passes rather than cache hits
+    predictor = PredictorBatcher(net, feature_cache_size=0)
+    obs = {
+        'map': torch.rand((1, config['dim_map_channels'], config['dim_map_size'], config['dim_map_size']), device=model.device),
+        'player': torch.rand((1, config['dim_player']), device=model.device),
+    }
+
+    counts = [0] * clients
+    deadline = time.perf_counter() + seconds
+
+    def _client(index):
+        while time.perf_counter() < deadline:
+            predictor.predict(obs)
+            counts[index] += 1
+
+    threads = [threading.Thread(target=_client, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return { 'predicts_per_sec': sum(counts) / seconds }
+
+def benchmark(config_path: str, clients: int, seconds: float, cores: int | None = None) -> list[dict]:
+    """
+    Sweeps intra/inter-op thread counts, each setting measured in a fresh pinned process.
+    Host throughput assumes cores // threads such processes side by side.
+    """
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    cores = min(cores or len(available), len(available))
+    thread_counts = sorted({t for t in (1, 2, 4, 8, 16, 32, 64) if t <= cores} | {cores})
+    results = []
+    for threads in thread_counts:
+        for interop_threads in (1, 2):
+            output = subprocess.run([
+                sys.executable, __file__, '--measure',
+                '--config', config_path,
+                '--threads', str(threads),
+                '--interop-threads', str(interop_threads),
+                '--cpus', ','.join(map(str, available[:threads])),
+                '--clients', str(clients),
+                '--seconds', str(seconds),
+            ], capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result['workers'] = cores // threads
+            result['host_predicts_per_sec'] = result['predicts_per_sec'] * result['workers']
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+    return sorted(results, key=lambda r: r['host_predicts_per_sec'], reverse=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark predictor thread and affinity layouts.")
+    parser.add_argument('--config', type=str, default='data/model/config.json')
+    parser.add_argument('--clients', type=int, default=64, help='Concurrent predict callers per process')
+    parser.add_argument('--seconds', type=float, default=5.0, help='Measurement time per setting')
+    parser.add_argument('--cores', type=int, default=None, help='Cores to plan the layout for (default: all available)')
+    parser.add_argument('--measure', action='store_true', help='Measure the given setting only (used by the sweep)')
+    with open(parser.parse_known_args()[0].config, 'r') as f:
+        config = json.load(f)
+    add_serving_args(parser, config)
+    args = parser.parse_args()
+
+    if args.measure:
+        applied = apply_serving_config(args.threads, args.interop_threads, args.cpus, args.worker)
+        print(json.dumps({ **applied, **measure(config, args.clients, args.seconds) }))
+    else:
+        results = benchmark(args.config, args.clients, args.seconds, args.cores)
+        best = results[0]
+        print(json.dumps({
+            'best': {
+                'num_threads': best['threads'],
+                'num_interop_threads': best['interop_threads'],
+                'workers': best['workers'],
+                'host_predicts_per_sec': best['host_predicts_per_sec'],
+            },
+            'results': results,
+        }, indent=4))
@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+if torch is not None:
+    import server
+    from client import PredictorClient
+
+class EchoPredictor:
+    """Stands in for PredictorBatcher, one result per observation holding its map shape."""
+    def submit(self, observations, heads, moves, callback, priority=None, timeout=None, block=True):
+        callback([{ 'shape': list(obs['map'].shape) } for obs in observations], None)
+
+@unittest.skipIf(torch is None, "torch is not installed")
+class TestLongLines(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'predictor.sock')
+        server.InferenceServer(EchoPredictor()).start('unix://' + self.path)
+        for _ in range(100):
+            if os.path.exists(self.path):
+                break
+            time.sleep(0.05)
+        self.client = PredictorClient('unix://' + self.path, timeout=10.0)
+
+    def tearDown(self):
+        self.client.close()
+        self.directory.cleanup()
+
+    def test_batch_over_default_stream_limit(self):
+        observations = [{ 'map': [[[0.5] * 16] * 16] * 8, 'player': [0.0] * 4 } for _ in range(64)]
+        self.assertGreater(len(json.dumps(observations)), 64 * 1024)
+        results = self.client.predict_batch(observations)
+        self.assertEqual(results, [{ 'shape': [1, 8, 16, 16] }] * 64)
+
+    def test_line_over_limit_keeps_connection(self):
+        limit = server.MAX_LINE
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(10.0)
+        connection.connect(self.path)
+        reader = connection.makefile('rb')
+        try:
+            connection.sendall(json.dumps({ 'cmd': 'stats', 'pad': 'x' * (limit + 1) }).encode() + b'\n')
+            self.assertIn('error', json.loads(reader.readline()))
+            connection.sendall(json.dumps({ 'cmd': 'stats', 'id': 1 }).encode() + b'\n')
+            reply = json.loads(reader.readline())
+            self.assertEqual(reply['id'], 1)
+            self.assertIn('result', reply)
+        finally:
+            reader.close()
+            connection.close()
+
+if __name__ == '__main__':
+    unittest.main()
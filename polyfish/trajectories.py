@@ -0,0 +1,229 @@
+import os
+import json
+import hashlib
+import numpy as np
+from gameTypes import MOVE_TYPE, MOVE_NAMES
+from obs import is_sparse, encode_sparse, decode_sparse
+
+# A game record, as produced by mcts.play_game_record:
+#   {
+#     'seed': map seed,
+#     'samples': [(obs, policy targets, move type)],
+#     'players': [player to move per sample],
+#     'rewards': [immediate reward of that player per sample],
+#     'outcomes': {player: final outcome in [-1, 1]},
+#   }
+GameRecord = dict
+
+def value_targets(players: list[int], rewards: list[float], outcomes: dict, gamma: float) -> list[float]:
+    """
+    Discounted return of each sample for its own player: its later rewards plus its final
+    outcome, discounted by gamma per move played (by anyone) in between.
+    """
+    running = {player: outcomes.get(player, 0.0) for player in set(players)}
+    values = [0.0] * len(players)
+    for t in reversed(range(len(players))):
+        running[players[t]] += rewards[t]
+        values[t] = running[players[t]]
+        for player in running:
+            running[player] *= gamma
+    return values
+
+def record_to_dataset(record: GameRecord, gamma: float) -> list:
+    values = value_targets(record['players'], record['rewards'], record['outcomes'], gamma)
+    return [
+        (obs, policies, { 'v_win': value }, move_type)
+        for (obs, policies, move_type), value in zip(record['samples'], values)
+    ]
+
+def observation_key(obs: dict) -> bytes:
+    """Digest of a dense or sparse observation, equal for equal observations in either form."""
+    map_obs = obs['map'] if is_sparse(obs['map']) else encode_sparse(obs['map'])
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.asarray(map_obs['shape'], dtype=np.int64).tobytes())
+    digest.update(np.asarray(map_obs['indices'], dtype=np.int64).tobytes())
+    digest.update(np.asarray(map_obs.get('values', []), dtype=np.float32).tobytes())
+    digest.update(np.asarray(obs['player'], dtype=np.float32).tobytes())
+    return digest.digest()
+
+def sample_weight(sample: tuple) -> float:
+    return sample[4] if len(sample) > 4 else 1.0
+
+def dedup_dataset(dataset: list) -> list:
+    """
+    Merges samples with equal observations into one, weighted by how many it replaces.
+    Policy and value targets become the weighted mean of the merged targets, which leaves the
+    weighted cross-entropy and MSE gradients unchanged, the move type is the first one seen.
+    Returns:
+        Dataset samples (obs, policy targets, value targets, move type, weight)
+    """
+    groups = {}
+    for sample in dataset:
+        groups.setdefault(observation_key(sample[0]), []).append(sample)
+
+    merged = []
+    for samples in groups.values():
+        if len(samples) == 1:
+            obs, policies, values, move_type = samples[0][:4]
+            merged.append((obs, policies, values, move_type, sample_weight(samples[0])))
+            continue
+
+        weights = [sample_weight(sample) for sample in samples]
+        policies = {}
+        for key in {key for sample in samples for key in sample[1]}:
+            targets = [(np.asarray(sample[1][key], dtype=np.float32), w) for sample, w in zip(samples, weights) if sample[1].get(key) is not None]
+            shape = targets[0][0].shape if targets else None
+            targets = [(target, w) for target, w in targets if target.shape == shape]
+            if targets:
+                policies[key] = (sum(target * w for target, w in targets) / sum(w for _, w in targets)).tolist()
+        values = {}
+        for key in {key for sample in samples for key in sample[2]}:
+            targets = [(sample[2][key], w) for sample, w in zip(samples, weights) if sample[2].get(key) is not None]
+            if targets:
+                values[key] = sum(target * w for target, w in targets) / sum(w for _, w in targets)
+        merged.append((samples[0][0], policies, values, samples[0][3], sum(weights)))
+    return merged
+
+class TrajectoryStore:
+    """
+    Self-play games on disk, grouped in compressed columnar chunks.
+
+    root/
+        index.jsonl          one line per game: id, chunk, sample range, seed, outcomes
+        chunk-000000.npz     per sample columns: game_id, turn, player, reward, move_type,
+                             map, player_obs, policy/<head>
+    Games are buffered in memory and written chunk_games at a time, call flush() to write
+    a partial chunk.
+    """
+    def __init__(self, root: str, chunk_games: int = 64):
+        self.root = root
+        self.chunk_games = chunk_games
+        self.buffer = []
+        self.index = []
+        os.makedirs(root, exist_ok=True)
+
+        index_path = os.path.join(root, 'index.jsonl')
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                self.index = [json.loads(line) for line in f if line.strip()]
+        self.next_chunk = max((entry['chunk'] for entry in self.index), default=-1) + 1
+        self.next_game = max((entry['game_id'] for entry in self.index), default=-1) + 1
+
+    def add_game(self, record: GameRecord) -> int:
+        game_id = self.next_game
+        self.next_game += 1
+        self.buffer.append((game_id, record))
+        if len(self.buffer) >= self.chunk_games:
+            self.flush()
+        return game_id
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = self.next_chunk
+        self.next_chunk += 1
+
+        columns = { 'game_id': [], 'turn': [], 'player': [], 'reward': [], 'move_type': [], 'map': [], 'player_obs': [] }
+        policy_dims = {}
+        for _, record in self.buffer:
+            for _, policies, _ in record['samples']:
+                for key, target in policies.items():
+                    policy_dims[key] = np.asarray(target).size
+        policies_columns = {key: [] for key in policy_dims}
+
+        entries = []
+        start = 0
+        for game_id, record in self.buffer:
+            samples = record['samples']
+            for turn, (obs, policies, move_type) in enumerate(samples):
+                columns['game_id'].append(game_id)
+                columns['turn'].append(turn)
+                columns['player'].append(record['players'][turn])
+                columns['reward'].append(record['rewards'][turn])
+                columns['move_type'].append(MOVE_TYPE.get(move_type, -1))
+                columns['map'].append(decode_sparse(obs['map']) if is_sparse(obs['map']) else np.asarray(obs['map']))
+                columns['player_obs'].append(np.asarray(obs['player']))
+                for key, dim in policy_dims.items():
+                    target = policies.get(key)
+                    policies_columns[key].append(np.zeros(dim) if target is None else np.asarray(target).reshape(dim))
+            entries.append({
+                'game_id': game_id,
+                'chunk': chunk,
+                'start': start,
+                'length': len(samples),
+                'seed': record.get('seed'),
+                'outcomes': {str(player): value for player, value in record['outcomes'].items()},
+            })
+            start += len(samples)
+
+        arrays = {
+            'game_id': np.array(columns['game_id'], dtype=np.int64),
+            'turn': np.array(columns['turn'], dtype=np.int32),
+            'player': np.array(columns['player'], dtype=np.int8),
+            'reward': np.array(columns['reward'], dtype=np.float32),
+            'move_type': np.array(columns['move_type'], dtype=np.int8),
+            'map': np.array(columns['map'], dtype=np.float16),
+            'player_obs': np.array(columns['player_obs'], dtype=np.float16),
+        }
+        for key, values in policies_columns.items():
+            arrays[f'policy/{key}'] = np.array(values, dtype=np.float16)
+        np.savez_compressed(self._chunk_path(chunk), **arrays)
+
+        with open(os.path.join(self.root, 'index.jsonl'), 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        self.index.extend(entries)
+        self.buffer = []
+
+    def games(self, seed: int | None = None) -> list[dict]:
+        """Index entries of the flushed games, optionally only those played on map seed."""
+        return [entry for entry in self.index if seed is None or entry['seed'] == seed]
+
+    def load_game(self, game_id: int) -> GameRecord:
+        entry = next(entry for entry in self.index if entry['game_id'] == game_id)
+        return self._load_records(entry['chunk'], [entry])[0]
+
+    def iter_records(self, game_ids: list[int] | None = None):
+        """Yields the GameRecords of game_ids (default: all), reading each chunk once."""
+        wanted = None if game_ids is None else set(game_ids)
+        by_chunk = {}
+        for entry in self.index:
+            if wanted is None or entry['game_id'] in wanted:
+                by_chunk.setdefault(entry['chunk'], []).append(entry)
+        for chunk, entries in sorted(by_chunk.items()):
+            yield from self._load_records(chunk, entries)
+
+    def iter_samples(self, gamma: float, game_ids: list[int] | None = None):
+        """Yields Dataset samples, value targets recomputed from the stored rewards with gamma."""
+        for record in self.iter_records(game_ids):
+            yield from record_to_dataset(record, gamma)
+
+    def _chunk_path(self, chunk: int) -> str:
+        return os.path.join(self.root, f'chunk-{chunk:06d}.npz')
+
+    def _load_records(self, chunk: int, entries: list[dict]) -> list[GameRecord]:
+        with np.load(self._chunk_path(chunk)) as data:
+            arrays = {key: data[key] for key in data.files}
+        policy_keys = [key for key in arrays if key.startswith('policy/')]
+
+        records = []
+        for entry in entries:
+            rows = range(entry['start'], entry['start'] + entry['length'])
+            records.append({
+                'seed': entry['seed'],
+                'samples': [
+                    (
+                        {
+                            'map': encode_sparse(arrays['map'][i].astype(np.float32)),
+                            'player': arrays['player_obs'][i].astype(np.float32).tolist(),
+                        },
+                        {key[len('policy/'):]: arrays[key][i].astype(np.float32).tolist() for key in policy_keys},
+                        MOVE_NAMES[arrays['move_type'][i]] if arrays['move_type'][i] >= 0 else 'None',
+                    )
+                    for i in rows
+                ],
+                'players': arrays['player'][rows.start:rows.stop].tolist(),
+                'rewards': arrays['reward'][rows.start:rows.stop].tolist(),
+                'outcomes': {int(player): value for player, value in entry['outcomes'].items()},
+            })
+        return records
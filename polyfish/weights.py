@@ -0,0 +1,55 @@
+import os
+import json
+import struct
+import numpy as np
+import torch
+
+# Flat weights file, safetensors-like:
+#   u64 little-endian header size | JSON header | tensor bytes
+# The header maps each tensor name to its dtype, shape and [start, end) byte range in the
+# data section, plus a '__metadata__' dict. Tensors are ALIGNMENT aligned so they can be
+# viewed straight out of a memory map.
+ALIGNMENT = 64
+
+def save_flat(state_dict: dict, filename: str, metadata: dict | None = None):
+    arrays = {key: value.detach().cpu().contiguous().numpy() for key, value in state_dict.items()}
+    header = { '__metadata__': metadata or {} }
+    offset = 0
+    for key, array in arrays.items():
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        header[key] = { 'dtype': array.dtype.name, 'shape': list(array.shape), 'offsets': [offset, offset + array.nbytes] }
+        offset += array.nbytes
+
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * (-(8 + len(header_bytes)) % ALIGNMENT)
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        data_start = f.tell()
+        for key, array in arrays.items():
+            f.seek(data_start + header[key]['offsets'][0])
+            f.write(array.tobytes())
+    # Replace atomically so processes mapping the old file keep a consistent view
+    os.replace(tmp, filename)
+
+def load_flat(filename: str) -> tuple[dict, dict]:
+    """
+    Maps filename copy-on-write: every process loading the same file shares its pages
+    until one of them writes to a tensor (e.g. while training).
+    Returns:
+        (state_dict of CPU tensors backed by the map, metadata)
+    """
+    buffer = np.memmap(filename, dtype=np.uint8, mode='c')
+    header_size = struct.unpack('<Q', buffer[:8].tobytes())[0]
+    header = json.loads(buffer[8:8 + header_size].tobytes())
+    data = buffer[8 + header_size:]
+
+    metadata = header.pop('__metadata__', {})
+    state_dict = {}
+    for key, info in header.items():
+        start, end = info['offsets']
+        array = data[start:end].view(np.dtype(info['dtype'])).reshape(info['shape'])
+        state_dict[key] = torch.from_numpy(array)
+    return state_dict, metadata